@@ -0,0 +1,180 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+try:
+    from .logger import log as logger
+    from .mk_db import Triage
+    from .mk_redis import Listen
+    from .redis_tools import connect_to_redis
+
+except ImportError:
+    from logger import log as logger
+    from mk_db import Triage
+    from mk_redis import Listen
+    from redis_tools import connect_to_redis
+
+class Async_Listen(Listen):
+    """
+    asyncio implementation of the Listen loop. Messages are read with
+    redis.asyncio and dispatched through the same channel_actions,
+    alerts_actions and sensor_actions tables as Listen, but every handler runs
+    in a thread pool so catalog queries and Redis writes never block the event
+    loop. Messages for the same product_id are handled in the order they
+    arrive; different subarrays are handled concurrently, so a slow
+    select_targets on one subarray does not hold up alerts for another.
+    Sensors listed in dispatch.coalesce are latest-value-wins: an update still
+    waiting behind earlier messages is dropped when a newer one arrives.
+
+    Requires redis-py 4.2 or later for redis.asyncio.
+
+    Examples:
+        >>> client = Async_Listen(['alerts', 'sensor_alerts'])
+        >>> client.start()
+    """
+    def __init__(self, chan = ['sensor_alerts', 'alerts'], host = 'localhost',
+                 port = 6379, max_workers = 8):
+        """
+        __init__ function for the Async_Listen class
+
+        Parameters:
+            chan: (str, list)
+                Channel pattern(s) to subscribe to
+            host: (str)
+                Redis host ip
+            port: (int)
+                Redis port
+            max_workers: (int)
+                Number of threads running handlers
+
+        Returns:
+            None
+        """
+        if aioredis is None:
+            raise ImportError('Async_Listen requires redis.asyncio (redis>=4.2)')
+
+        threading.Thread.__init__(self)
+
+        self.chan = [chan] if isinstance(chan, str) else list(chan)
+        self.host = host
+        self.port = port
+
+        # Blocking client used by the handlers from the worker threads
+        self.redis_server = connect_to_redis(host = host, port = port)
+
+        # Database connection and triaging
+        self.engine = Triage()
+
+        self.sensor_info = {}
+        self._deltas = {}
+        self._init_actions()
+        self.writer = self._init_writer(self.chan)
+
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.loop = None
+        self.p = None
+        self._locks = {}
+        self._tasks = set()
+        self._latest = {}
+        self._seq = 0
+        self.dropped = 0
+        self.coalesce = set(self.engine.cfg.get('dispatch', {}).get(
+                            'coalesce', ['target']) or [])
+
+    def run(self):
+        """Runs the event loop until the subscription is closed. Can be called
+           directly or through start() like Listen.
+        """
+        asyncio.run(self.listen())
+
+    async def listen(self):
+        """Subscribes to the channels and dispatches every message that comes
+           in as a separate task
+        """
+        self.loop = asyncio.get_running_loop()
+        server = aioredis.Redis(host = self.host, port = self.port,
+                                decode_responses = True)
+        self.p = server.pubsub(ignore_subscribe_messages = True)
+        await self.p.psubscribe(*self.chan)
+
+        try:
+            async for item in self.p.listen():
+                if item is None or item['type'] not in ('message', 'pmessage'):
+                    continue
+                task = asyncio.ensure_future(self._dispatch(item['channel'],
+                                                            item['data']))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions = True)
+            await self.p.close()
+            await server.close()
+
+    async def _dispatch(self, channel, data):
+        """Runs the handler for a message in the thread pool, after any earlier
+           message for the same product_id
+
+        Parameters:
+            channel: (str)
+                Channel the message arrived on
+            data: (str)
+                Message passed over the channel
+
+        Returns:
+            None
+        """
+        lock = self._locks.setdefault(self._message_product(channel, data),
+                                      asyncio.Lock())
+        func = self._message_to_func(channel, self.channel_actions)
+
+        coalesce = self._coalesce_key(channel, data)
+        if coalesce is not None:
+            self._seq += 1
+            seq = self._seq
+            if coalesce in self._latest:
+                self.dropped += 1
+            self._latest[coalesce] = seq
+
+        async with lock:
+            if coalesce is not None:
+                if self._latest.get(coalesce) != seq:
+                    return
+                del self._latest[coalesce]
+            try:
+                await self.loop.run_in_executor(self.executor, func, data)
+            except Exception as e:
+                logger.error('Handler for {} failed on {}: {}'.format(channel, data, e))
+
+    def _unsubscribe(self, channels = None):
+        """Unsubscribe from the redis server. Safe to call from any thread.
+
+        Parameters:
+            channels: (str, list)
+                List of channels you wish to unsubscribe to
+
+        Returns:
+            None
+        """
+        if self.loop is None or self.p is None:
+            return
+
+        channels = [] if channels is None else \
+                   [channels] if isinstance(channels, str) else list(channels)
+        asyncio.run_coroutine_threadsafe(self.p.punsubscribe(*channels), self.loop)
+        logger.info('Unsubscribed from channel(s)')
+
+    def stop(self):
+        """Waits for the running handlers, writes the pending observation
+           bookkeeping and closes the database connections and catalog
+           search. Called on shutdown.
+        """
+        self.executor.shutdown(wait = True)
+        if self.writer is not None:
+            self.writer.stop()
+        self.engine.close_conn()
@@ -0,0 +1,308 @@
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+try:
+    from .logger import log as logger
+
+except ImportError:
+    from logger import log as logger
+
+class Observation_Cache(object):
+    """
+    In-memory copy of the observation history. For every source that has been
+    observed it keeps the number of observations and their total duration in
+    sorted NumPy arrays. The arrays are loaded once from the observation table,
+    updated as the target selector writes to that table, and periodically
+    resynchronised by reading only the rows added since the last sync (rowid
+    high-water mark). Each resync also re-reads the last overlap rowids below
+    the mark and skips the ones already merged, so a row whose transaction
+    commits after a higher rowid was read is still picked up. Sources written
+    by this process are marked as observed immediately; their counts and
+    durations follow at the next resync.
+
+    Examples:
+        >>> cache = Observation_Cache(conn)
+        >>> cache.contains(tb['source_id'].values)
+    """
+    def __init__(self, conn, table = 'observation_status', resync_interval = 60.0,
+                 overlap = 1000):
+        """
+        __init__ function for the Observation_Cache class
+
+        Parameters:
+            conn: SQLalchemy engine or connection
+                SQLalchemy connection to the database
+            table: (str)
+                Name of the observation metadata table
+            resync_interval: (float)
+                Seconds between resynchronisations with the database
+            overlap: (int)
+                Number of rowids below the high-water mark read again at each
+                resync
+
+        Returns:
+            None
+        """
+        self.conn = conn
+        self.table = table
+        self.resync_interval = resync_interval
+        # (ids, n_obs, duration) are replaced together so readers never see
+        # arrays of different lengths
+        self._state = (np.empty(0, dtype = np.int64),
+                       np.empty(0, dtype = np.int64),
+                       np.empty(0, dtype = np.float64))
+        self.high_water = 0
+        self.overlap = overlap
+        # Rowids within the overlap window that have already been merged
+        self._recent = np.empty(0, dtype = np.int64)
+        self.last_sync = 0.0
+        self._lock = threading.Lock()
+        # Serialises the read of new rows, the merge and the high-water update
+        # so concurrent resyncs never count a row twice
+        self._resync_lock = threading.Lock()
+        self.resync()
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    @property
+    def ids(self):
+        return self._state[0]
+
+    def resync(self, max_age = None):
+        """Reads the rows added to the observation table since the last sync
+
+        Parameters:
+            max_age: (float)
+                Skip the resync if another thread synced less than max_age
+                seconds ago. None always resyncs.
+
+        Returns:
+            n: (int)
+                Number of new rows read from the database
+        """
+        with self._resync_lock:
+            if max_age is not None and time.time() - self.last_sync <= max_age:
+                return 0
+
+            low = max(self.high_water - self.overlap, 0)
+            query = 'SELECT rowid, source_id, duration \
+                     FROM {} WHERE rowid > {}'.format(self.table, low)
+
+            try:
+                rows = pd.read_sql(query, con = self.conn)
+            except Exception as e:
+                logger.warning('Observation cache resync failed: {}'.format(e))
+                return 0
+
+            rowids = rows['rowid'].values.astype(np.int64)
+            rows = rows[~np.isin(rowids, self._recent)]
+            if rows.shape[0]:
+                self._merge(rows['source_id'].values,
+                            np.ones(rows.shape[0], dtype = np.int64),
+                            rows['duration'].fillna(0.0).values)
+                self.high_water = max(self.high_water, int(rows['rowid'].max()))
+
+            recent = np.union1d(self._recent, rowids)
+            self._recent = recent[recent > self.high_water - self.overlap]
+            self.last_sync = time.time()
+            return rows.shape[0]
+
+    def maybe_resync(self):
+        """Resynchronises with the database if the resync interval has passed
+        """
+        if time.time() - self.last_sync > self.resync_interval:
+            self.resync(max_age = self.resync_interval)
+
+    def add(self, source_ids):
+        """Marks sources as observed
+
+        Parameters:
+            source_ids: (int, np.ndarray)
+                IDs of the observed sources
+
+        Returns:
+            None
+        """
+        source_ids = np.atleast_1d(np.asarray(source_ids, dtype = np.int64))
+        self._merge(source_ids, np.zeros(source_ids.shape, dtype = np.int64),
+                    np.zeros(source_ids.shape, dtype = np.float64))
+
+    def _merge(self, source_ids, n_obs, duration):
+        """Adds per-row observation counts and durations to the cached totals
+        """
+        source_ids = np.asarray(source_ids, dtype = np.int64)
+        new_ids, inverse = np.unique(source_ids, return_inverse = True)
+        inverse = inverse.ravel()
+        new_n = np.bincount(inverse, weights = n_obs, minlength = new_ids.shape[0])
+        new_d = np.bincount(inverse, weights = duration, minlength = new_ids.shape[0])
+
+        with self._lock:
+            ids, n, d = self._state
+            all_ids = np.union1d(ids, new_ids)
+            all_n = np.zeros(all_ids.shape, dtype = np.int64)
+            all_d = np.zeros(all_ids.shape, dtype = np.float64)
+            old = np.searchsorted(all_ids, ids)
+            all_n[old] = n
+            all_d[old] = d
+            new = np.searchsorted(all_ids, new_ids)
+            all_n[new] += new_n.astype(np.int64)
+            all_d[new] += new_d
+            self._state = (all_ids, all_n, all_d)
+
+    def lookup(self, source_ids):
+        """Returns the observation history of a set of sources
+
+        Parameters:
+            source_ids: (np.ndarray)
+                IDs of the sources to look up
+
+        Returns:
+            observed: (np.ndarray)
+                True where the source has been observed before
+            n_obs: (np.ndarray)
+                Number of previous observations
+            duration: (np.ndarray)
+                Total duration of previous observations in seconds
+        """
+        ids, n, d = self._state
+        source_ids = np.asarray(source_ids, dtype = np.int64)
+        if ids.shape[0] == 0:
+            return (np.zeros(source_ids.shape, dtype = bool),
+                    np.zeros(source_ids.shape, dtype = np.int64),
+                    np.zeros(source_ids.shape, dtype = np.float64))
+
+        pos = np.minimum(np.searchsorted(ids, source_ids), ids.shape[0] - 1)
+        observed = ids[pos] == source_ids
+        return (observed, np.where(observed, n[pos], 0),
+                np.where(observed, d[pos], 0.0))
+
+    def contains(self, source_ids):
+        """Returns a boolean mask marking which sources have been observed
+
+        Parameters:
+            source_ids: (np.ndarray)
+                IDs of the sources to look up
+
+        Returns:
+            mask: (np.ndarray)
+                True where the source has been observed before
+        """
+        return self.lookup(source_ids)[0]
+
+class Pointing_Cache(object):
+    """
+    Bounded least-recently-used cache of cone search results. Keys are pointing
+    coordinates and beam radius quantised to a fixed step, so repeated pointings
+    at the same field skip the catalog query. Only the spatial part of the
+    result is cached; priorities are assigned afresh by the caller.
+
+    Examples:
+        >>> cache = Pointing_Cache(maxsize = 256)
+        >>> key = cache.key(c_ra, c_dec, beam_rad)
+        >>> tb = cache.get(key)
+    """
+    def __init__(self, maxsize = 256, ttl = None, quantum = 1e-6):
+        """
+        __init__ function for the Pointing_Cache class
+
+        Parameters:
+            maxsize: (int)
+                Maximum number of cached pointings
+            ttl: (float)
+                Seconds after which a cached entry expires. None disables expiry
+            quantum: (float)
+                Quantisation step in radians applied to the cache keys
+
+        Returns:
+            None
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, c_ra, c_dec, beam_rad, *extra):
+        """Returns the cache key of a pointing
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+            extra:
+                Any other hashable values the result depends on
+
+        Returns:
+            key: (tuple)
+        """
+        q = self.quantum
+        return (int(round((c_ra % (2.0 * np.pi)) / q)), int(round(c_dec / q)),
+                int(round(beam_rad / q))) + tuple(extra)
+
+    def get(self, key):
+        """Returns the cached result for a key, or None on a miss
+
+        Parameters:
+            key: (tuple)
+                Key returned by Pointing_Cache.key
+
+        Returns:
+            tb: (pandas.DataFrame, None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and \
+                    time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, tb):
+        """Stores a result, evicting the least recently used entry if the
+        cache is full
+
+        Parameters:
+            key: (tuple)
+                Key returned by Pointing_Cache.key
+            tb: (pandas.DataFrame)
+                Result of the cone search
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries[key] = (time.time(), tb)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        """Removes every cached entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters
+
+        Returns:
+            stats: (dict)
+                Number of hits, misses and cached entries
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
@@ -1,16 +1,38 @@
+import os
 import yaml
+import threading
 import numpy as np
 import pandas as pd
 from dateutil import parser
 from datetime import datetime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.engine.url import URL
 
 try:
     from .logger import log as logger
+    from .mk_index import Sky_Index, read_manifest
+    from .mk_tiles import Tile_Catalog
+    from .mk_shard import shared_search
+    from .mk_cache import Observation_Cache, Pointing_Cache
+    from .mk_priority import Priority_Scorer
+    from . import sky_tools
 
 except ImportError:
     from logger import log as logger
+    from mk_index import Sky_Index, read_manifest
+    from mk_tiles import Tile_Catalog
+    from mk_shard import shared_search
+    from mk_cache import Observation_Cache, Pointing_Cache
+    from mk_priority import Priority_Scorer
+    import sky_tools
+
+# Column order of the rows written to the observation table
+OBSERVATION_COLUMNS = ['source_id', 'duration', 'time', 'mode', 'file_id',
+                       'proxies', 'bands', 'antennas']
+
+# Engines (connection pools) shared by every Database_Handler in the process
+_engines = {}
+_engines_lock = threading.Lock()
 
 class Database_Handler(object):
     """
@@ -34,7 +56,15 @@ class Database_Handler(object):
         """
         self.cfg = self.configure_settings(config_file)
         #self.priority_sources = np.array(self.cfg['priority_sources'])
-        self.conn = self.connect_to_db(self.cfg['mysql'])
+
+        if 'sqlite' in self.cfg:
+            self.engine = self.connect_to_db(dict({'drivername': 'sqlite'},
+                                                  **self.cfg['sqlite']))
+        else:
+            self.engine = self.connect_to_db(self.cfg['mysql'],
+                                             self.cfg.get('pool', {}))
+
+        self.backend = self.engine.dialect.name
 
 
     def configure_settings(self, config_file):
@@ -59,25 +89,70 @@ class Database_Handler(object):
         except IOError:
             logger.error('Config file not found')
 
-    def connect_to_db(self, cred):
+    def connect_to_db(self, cred, pool = {}):
         """
-        Connects to the Breakthrough Listen database
+        Returns the connection pool to the Breakthrough Listen database. Every
+        Database_Handler in the process connecting with the same credentials
+        shares one bounded pool; queries check a connection out only for as
+        long as they run.
 
         Parameters:
             cred: (dict)
-                Dictionary containing information on the source list database
+                Dictionary containing information on the source list database.
+                A drivername of 'sqlite' with a database path opens a local
+                SQLite file instead of a MySQL server.
+            pool: (dict)
+                Pool settings: pool_size, max_overflow, pool_timeout,
+                pool_recycle (seconds) and pool_pre_ping
 
         Returns:
-            conn : sqlalchemy connection
-                SQLalchemy connection to the database containing sources for
+            engine : sqlalchemy engine
+                SQLalchemy engine for the database containing sources for
                 triaging
         """
         url = URL(**cred)
-        self.engine = create_engine(name_or_url = url)
-        return self.engine.connect()
+        key = (str(url), tuple(sorted(pool.items())))
+
+        with _engines_lock:
+            if key not in _engines:
+                kwargs = {}
+                if url.drivername != 'sqlite':
+                    kwargs = {'pool_size': pool.get('pool_size', 5),
+                              'max_overflow': pool.get('max_overflow', 5),
+                              'pool_timeout': pool.get('pool_timeout', 30),
+                              'pool_recycle': pool.get('pool_recycle', 3600),
+                              'pool_pre_ping': pool.get('pool_pre_ping', True)}
+                _engines[key] = create_engine(name_or_url = url, **kwargs)
+
+            return _engines[key]
+
+    def load_index(self, snapshot = None, table = 'target_list'):
+        """Returns the in-memory spatial index of the catalog. If a snapshot
+        directory is given and its checksum matches the table, the snapshot is
+        memory-mapped; otherwise the index is built from the database.
+
+        Parameters:
+            snapshot: (str)
+                Directory of a snapshot written by Sky_Index.save
+            table: (str)
+                Name of the table containing the catalog
+
+        Returns:
+            index: (Sky_Index)
+        """
+        if snapshot and os.path.exists(os.path.join(snapshot, 'manifest.json')):
+            checksum = Sky_Index.table_checksum(self.engine, table)
+            if read_manifest(snapshot).get('checksum') == checksum:
+                logger.info('Memory-mapping index snapshot {}'.format(snapshot))
+                return Sky_Index.load(snapshot)
+
+            logger.warning('Index snapshot {} does not match {}. Loading from '
+                           'the database instead'.format(snapshot, table))
+
+        return Sky_Index.from_sql(self.engine, table)
 
     def close_conn(self):
-        """Close the connection to the database
+        """Close the pooled connections to the database
 
         Parameters:
             None
@@ -85,7 +160,6 @@ class Database_Handler(object):
         Returns:
             None
         """
-        self.conn.close()
         self.engine.dispose()
 
 
@@ -107,11 +181,90 @@ class Triage(Database_Handler):
     """
     def __init__(self, config_file = 'config.yml'):
         super(Triage, self).__init__(config_file)
+        self.index = None
+
+        index_cfg = self.cfg.get('index', {})
+        if index_cfg.get('tiles'):
+            logger.info('Using tile catalog {}'.format(index_cfg['tiles']))
+            self.index = Tile_Catalog(index_cfg['tiles'],
+                                      max_tiles = index_cfg.get('max_tiles', 64))
+        elif index_cfg.get('enabled', False) and index_cfg.get('processes', 0) > 1:
+            # One search service per process, shared by every Triage
+            self.index = shared_search(lambda: self.load_index(index_cfg.get('snapshot')),
+                                       n_workers = index_cfg['processes'],
+                                       n_shards = index_cfg.get('shards'),
+                                       min_batch = index_cfg.get('min_batch', 16))
+        elif index_cfg.get('enabled', False):
+            self.index = self.load_index(index_cfg.get('snapshot'))
+
+        # A tile catalog may stand in for target_list entirely
+        inspector = inspect(self.engine)
+        columns = [c['name'] for c in inspector.get_columns('target_list')] \
+                  if 'target_list' in inspector.get_table_names() else []
+        self.cell_columns = set(['cx', 'cy', 'cz', 'cell']).issubset(columns)
+        self._migrate_observations(inspector)
+
+        observed_cfg = self.cfg.get('observed_cache', {})
+        self.observed = Observation_Cache(self.engine,
+                                          resync_interval = observed_cfg.get('resync_interval', 60.0),
+                                          overlap = observed_cfg.get('overlap', 1000))
+
+        self.scorer = Priority_Scorer(self.cfg.get('priority', {}))
+
+        cache_cfg = self.cfg.get('pointing_cache', {})
+        self.pointings = Pointing_Cache(maxsize = cache_cfg.get('maxsize', 256),
+                                        ttl = cache_cfg.get('ttl', None),
+                                        quantum = cache_cfg.get('quantum', 1e-6))
+
+    def close_conn(self):
+        """Releases the search service, if any, and closes the pooled
+        connections to the database
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        if hasattr(self.index, 'close'):
+            self.index.close()
+            self.index = None
+        super(Triage, self).close_conn()
+
+    def _migrate_observations(self, inspector, table = 'observation_status'):
+        """Adds the success column to observation tables created before it
+        existed
+
+        Parameters:
+            inspector: (sqlalchemy.engine.reflection.Inspector)
+                Inspector of the database
+            table: (str)
+                name of the observation metadata table
+
+        Returns:
+            None
+        """
+        if table not in inspector.get_table_names():
+            return
+        if 'success' in [c['name'] for c in inspector.get_columns(table)]:
+            return
+
+        logger.info('Adding success column to {}'.format(table))
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('ALTER TABLE {} ADD COLUMN success BOOLEAN DEFAULT 0'.format(table))
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
 
     def add_sources_to_db(self, df, start_time, end_time, proxies, antennas,
                           file_id, bands, mode = 0, table = 'observation_status'):
         """
-        Adds a pandas DataFrame to a specified table
+        Adds the sources of a field to a specified table with one DB-API
+        executemany built from the source_id array and the observation
+        constants. mysqlclient sends this as a single multi-row INSERT.
 
         Parameters:
             df: (pandas.DataFrame)
@@ -129,25 +282,41 @@ class Triage(Database_Handler):
                 If sources were successfully added to the database, returns True.
                 Else, returns False.
         """
-
-        source_tb = df.loc[:, ['source_id']]
-        source_tb['duration'] = (end_time - start_time).total_seconds()
-        source_tb['time'] = start_time
-        source_tb['mode'] = mode
-        source_tb['file_id'] = file_id
-        source_tb['proxies'] = proxies
-        source_tb['bands'] = bands
-        source_tb['antennas'] = antennas
-
-        try:
-            source_tb.to_sql(table, self.conn, if_exists='append', index=False)
+        source_ids = np.asarray(df['source_id'].values, dtype = np.int64)
+        if source_ids.shape[0] == 0:
             return True
 
+        rows = observation_rows(source_ids, start_time, end_time, proxies,
+                                antennas, file_id, bands, mode)
+        try:
+            self.insert_observations(rows, table)
         except Exception as e:
-            print (e)
-            logger.warning('Was not able to add sources to the database!')
+            logger.error('Was not able to add {} sources to {}: {}'.format(
+                         len(rows), table, e))
             return False
 
+        if table == self.observed.table:
+            self.observed.add(source_ids)
+        return True
+
+    def insert_observations(self, rows, table = 'observation_status'):
+        """Inserts observation rows in one executemany. Raises on failure.
+
+        Parameters:
+            rows: (list)
+                Tuples ordered as OBSERVATION_COLUMNS, see observation_rows
+            table: (str)
+                name of the observation metadata table
+
+        Returns:
+            None
+        """
+        marker = self._param_marker()
+        insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                 table, ', '.join(OBSERVATION_COLUMNS),
+                 ', '.join([marker] * len(OBSERVATION_COLUMNS)))
+        self._executemany(insert, rows)
+
     def update_obs_status(self, source_id, obs_start_time,
                           success, table = 'observation_status'):
         """
@@ -166,15 +335,60 @@ class Triage(Database_Handler):
         Returns:
             None
         """
+        self.update_statuses([(success, source_id, obs_start_time)], table)
 
-        update = """\
-                    UPDATE {table}
-                    SET success = {success}
-                    WHERE (source_id = {id} AND obs_start_time = '{time}');
-                 """.format(table = table, id = source_id,
-                            time = parser.parse(obs_start_time),
-                            success = success)
-        self.conn.execute(update)
+        if table == self.observed.table:
+            self.observed.add(source_id)
+
+    def update_statuses(self, rows, table = 'observation_status'):
+        """Updates the success column of several observations with one
+        parameterized executemany. Observations are matched on source_id and
+        their start time, stored in the time column. Raises on failure and
+        logs a warning when some rows match no observation.
+
+        Parameters:
+            rows: (list)
+                (success, source_id, obs_start_time) tuples. obs_start_time may
+                be a datetime or a string
+            table: (str)
+                name of the observation metadata table
+
+        Returns:
+            n: (int)
+                Number of rows updated
+        """
+        marker = self._param_marker()
+        update = 'UPDATE {} SET success = {} WHERE (source_id = {} AND ' \
+                 'time = {})'.format(table, marker, marker, marker)
+        rows = [(bool(success), int(source_id), parser.parse(str(time)))
+                for success, source_id, time in rows]
+        n = self._executemany(update, rows)
+        if n is not None and 0 <= n < len(rows):
+            logger.warning('{} of {} status update(s) matched no observation in '
+                           '{}'.format(len(rows) - n, len(rows), table))
+        return n
+
+    def _param_marker(self):
+        """Returns the DB-API parameter marker of the database driver"""
+        return '?' if self.engine.dialect.paramstyle == 'qmark' else '%s'
+
+    def _executemany(self, statement, rows):
+        """Runs a statement for every row on one pooled connection and commits.
+        Rolls back and re-raises on failure. Returns the driver's row count.
+        """
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany(statement, rows)
+            n = cursor.rowcount
+            cursor.close()
+            conn.commit()
+            return n
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
 
     def _box_filter(self, c_ra, c_dec, beam_rad, table, cols):
         """Returns a string which acts as a pre-filter for the more computationally
@@ -226,10 +440,98 @@ class Triage(Database_Handler):
                            dec_min = bounds[2], dec_max = bounds[3])
         return query
 
+    def _cell_filter(self, c_ra, c_dec, beam_rad, table, cols):
+        """Returns a query string that selects sources through the indexed
+        HEALPix cell column and keeps those whose unit vector lies within the
+        beam, avoiding any trigonometry on the database side
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+            table: (str)
+                Table within database where
+            cols: (list)
+                Columns to select within the table
+        Returns:
+            query: str
+                SQL query string
+        """
+        x0, y0, z0 = sky_tools.radec_to_vec(c_ra, c_dec)
+        ranges = sky_tools.disc_ranges(c_ra, c_dec, beam_rad)
+        cells = ' OR '.join('(cell BETWEEN {} AND {})'.format(a, b - 1)
+                            for a, b in ranges)
+
+        query = """
+                SELECT {cols}
+                FROM {table}
+                WHERE ({cells}) AND
+                      (cx * {x0!r} + cy * {y0!r} + cz * {z0!r} > {cos_rad!r})\
+                """.format(cols = ', '.join(cols), table = table, cells = cells,
+                           x0 = float(x0), y0 = float(y0), z0 = float(z0),
+                           cos_rad = float(np.cos(beam_rad)))
+        return query
+
+    def _rtree_filter(self, c_ra, c_dec, beam_rad, table, cols):
+        """Returns a query string for the SQLite backend. Candidates come from
+        the R*Tree built over (ra, decl) by configure_db.py and are kept if
+        their unit vector lies within the beam. A box crossing RA = 0 is split
+        in two.
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+            table: (str)
+                Table within database where
+            cols: (list)
+                Columns to select within the table
+        Returns:
+            query: str
+                SQL query string
+        """
+        if abs(c_dec) + beam_rad >= np.pi / 2.0:
+            ra_offset = np.pi
+        else:
+            ra_offset = np.arcsin(np.sin(beam_rad) / np.cos(c_dec))
+
+        dec_min = max(np.rad2deg(c_dec - beam_rad), -90.0)
+        dec_max = min(np.rad2deg(c_dec + beam_rad), 90.0)
+        ra_min = np.rad2deg(c_ra - ra_offset) % 360.0
+        ra_max = np.rad2deg(c_ra + ra_offset) % 360.0
+
+        if ra_offset >= np.pi:
+            boxes = [(0.0, 360.0)]
+        elif ra_min > ra_max:
+            boxes = [(ra_min, 360.0), (0.0, ra_max)]
+        else:
+            boxes = [(ra_min, ra_max)]
+
+        x0, y0, z0 = sky_tools.radec_to_vec(c_ra, c_dec)
+        select = """
+                SELECT {cols}
+                FROM {table} AS T JOIN {table}_rtree AS R ON T.rowid = R.id
+                WHERE R.ra_max >= {ra_min!r} AND R.ra_min <= {ra_max!r} AND
+                      R.decl_max >= {dec_min!r} AND R.decl_min <= {dec_max!r} AND
+                      (T.cx * {x0!r} + T.cy * {y0!r} + T.cz * {z0!r} > {cos_rad!r})\
+                 """
+        query = ' UNION ALL '.join(
+                select.format(cols = ', '.join('T.' + c for c in cols),
+                              table = table, ra_min = float(a), ra_max = float(b),
+                              dec_min = float(dec_min), dec_max = float(dec_max),
+                              x0 = float(x0), y0 = float(y0), z0 = float(z0),
+                              cos_rad = float(np.cos(beam_rad)))
+                for a, b in boxes)
+        return query
+
     def triage(self, tb, table = 'observation_status'):
         """
-        Returns an array of priority values (or maybe the table with priority values
-        appended)
+        Returns the table with priority values appended, sorted so that the
+        sources to observe first come first. The score is computed by
+        Priority_Scorer from the observation history, project and distance
+        from the beam centre.
 
         Parameters:
             tb: (pandas.DataFrame)
@@ -240,16 +542,23 @@ class Triage(Database_Handler):
             tb: (pandas.DataFrame)
                 table containing the sources to be beamformed on
         """
-        priority = np.ones(tb.shape[0], dtype=int)
+        source_ids = tb['source_id'].values
+
+        if table == self.observed.table:
+            self.observed.maybe_resync()
+            observed, n_obs, duration = self.observed.lookup(source_ids)
+
+        else:
+            query = 'SELECT DISTINCT source_id \
+                     FROM {}'.format(table)
 
-        query = 'SELECT DISTINCT source_id \
-                 FROM {}'.format(table)
+            # TODO replace these with sqlalchemy queries
+            previous = pd.read_sql(query, con = self.engine)
+            observed = tb['source_id'].isin(previous['source_id']).values
+            n_obs = observed.astype(int)
+            duration = np.zeros(tb.shape[0])
 
-        # TODO replace these with sqlalchemy queries
-        source_ids = pd.read_sql(query, con = self.conn)
-        priority[tb['source_id'].isin(source_ids['source_id'])] += 1
-        #priority[tb['source_id'].isin(self.priority_sources)] = 0
-        tb['priority'] = priority
+        tb = self.scorer.score(tb, observed, n_obs, duration)
         return tb.sort_values('priority')
 
     def select_targets(self, c_ra, c_dec, beam_rad, table = 'target_list',
@@ -274,18 +583,138 @@ class Triage(Database_Handler):
                 criteria
 
         """
+        key = self.pointings.key(c_ra, c_dec, beam_rad, table, tuple(cols))
+        tb = self.pointings.get(key)
+
+        if tb is None:
+            if self.index is not None and table == 'target_list':
+                tb = self.index.select_targets(c_ra, c_dec, beam_rad)
+
+            else:
+                query = self._cone_query(c_ra, c_dec, beam_rad, table, cols)
+
+                # TODO: replace with sqlalchemy queries
+                tb = pd.read_sql(query, con = self.engine)
+                tb['separation'] = sky_tools.separation(tb['ra'].values,
+                                                        tb['decl'].values,
+                                                        c_ra, c_dec)
+
+            self.pointings.put(key, tb)
+
+        source_list = self.triage(tb.copy())
+
+        return source_list
+
+    def select_targets_many(self, pointings, beam_rad, table = 'target_list',
+                            cols = ['ra', 'decl', 'source_id', 'Project']):
+        """Finds the sources within the primary beam of several pointings at
+           once. Pointings missing from the pointing cache are resolved in a
+           single pass over the catalog and triage is run once on the combined
+           table.
+
+        Parameters:
+            pointings: (list)
+                List of (c_ra, c_dec) pointing coordinates in radians
+            beam_rad: float
+                Angular radius of the primary beam in radians
+            table : str
+                Name of the table that is being queried
+
+        Returns:
+            source_lists : list
+                One pandas DataFrame per pointing, in the order of pointings
+        """
+        pointings = list(pointings)
+        if not pointings:
+            return []
+
+        keys = [self.pointings.key(c_ra, c_dec, beam_rad, table, tuple(cols))
+                for c_ra, c_dec in pointings]
+        cached = [self.pointings.get(k) for k in keys]
+        missing = [i for i, tb in enumerate(cached) if tb is None]
+
+        if missing:
+            todo = [pointings[i] for i in missing]
+            if self.index is not None and table == 'target_list':
+                tb = self.index.select_targets_many(todo, beam_rad)
+
+            else:
+                query = ' UNION ALL '.join(
+                        'SELECT *, {i} AS pointing FROM ({cone}) AS P{i}'.format(
+                        i = i, cone = self._cone_query(c_ra, c_dec, beam_rad,
+                                                       table, cols))
+                        for i, (c_ra, c_dec) in enumerate(todo))
+                tb = pd.read_sql(query, con = self.engine)
+                c_ra, c_dec = np.asarray(todo, dtype = np.float64).T
+                p = tb['pointing'].values.astype(np.int64)
+                tb['separation'] = sky_tools.separation(tb['ra'].values,
+                                                        tb['decl'].values,
+                                                        c_ra[p], c_dec[p])
+
+            groups = dict(list(tb.groupby('pointing', sort = False)))
+            empty = tb.iloc[:0].drop(columns = 'pointing')
+            for j, i in enumerate(missing):
+                cached[i] = groups[j].drop(columns = 'pointing') if j in groups else empty
+                self.pointings.put(keys[i], cached[i])
+
+        tb = pd.concat([c.assign(pointing = i) for i, c in enumerate(cached)],
+                       ignore_index = True)
+        tb = self.triage(tb)
+        groups = dict(list(tb.groupby('pointing', sort = False)))
+        empty = tb.iloc[:0].drop(columns = 'pointing')
+        return [groups[i].drop(columns = 'pointing') if i in groups else empty
+                for i in range(len(pointings))]
+
+    def _cone_query(self, c_ra, c_dec, beam_rad, table, cols):
+        """Returns the query string selecting the sources within some primary
+           beam area
+
+        Parameters:
+            c_ra, c_dec : float
+                Pointing coordinates of the telescope in radians
+            beam_rad: float
+                Angular radius of the primary beam in radians
+            table : str
+                Name of the table that is being queried
+            cols: (list)
+                Columns to select within the table
+
+        Returns:
+            query: str
+                SQL query string
+        """
+        if self.backend == 'sqlite' and table == 'target_list':
+            return self._rtree_filter(c_ra, c_dec, beam_rad, table, cols)
+
+        if self.cell_columns and table == 'target_list':
+            return self._cell_filter(c_ra, c_dec, beam_rad, table, cols)
+
         mask = self._box_filter(c_ra, c_dec, beam_rad, table, cols)
 
         query = """\
                 SELECT *
                 FROM ({mask}) as T
                 WHERE ACOS( SIN(RADIANS(decl)) * SIN({c_dec}) + COS(RADIANS(decl)) *
-                COS({c_dec}) * COS({c_ra} - RADIANS(ra))) < {beam_rad}; \
+                COS({c_dec}) * COS({c_ra} - RADIANS(ra))) < {beam_rad}\
                 """.format(mask = mask, c_ra = c_ra,
                            c_dec = c_dec, beam_rad = beam_rad)
+        return query
 
-        # TODO: replace with sqlalchemy queries
-        tb = pd.read_sql(query, con = self.conn)
-        source_list = self.triage(tb)
+def observation_rows(source_ids, start_time, end_time, proxies, antennas,
+                     file_id, bands, mode = 0):
+    """Returns the observation table rows of a set of sources, ordered as
+    OBSERVATION_COLUMNS
 
-        return source_list
+    Parameters:
+        source_ids: (np.ndarray)
+            IDs of the observed sources
+        start_time, end_time: (datetime)
+            Start and end of the observation
+
+    Returns:
+        rows: (list)
+            One tuple per source
+    """
+    constants = ((end_time - start_time).total_seconds(), start_time, mode,
+                 file_id, proxies, bands, antennas)
+    return [(i,) + constants for i in np.asarray(source_ids, dtype = np.int64).tolist()]
@@ -1,7 +1,8 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from astropy import units as u
 from astropy.time import Time
-from astropy.coordinates import EarthLocation, AltAz
+from astropy.coordinates import EarthLocation, AltAz, SkyCoord
 
 def calc_delay(ant_pos, p_az, p_alt, az, alt):
     """Calculates the antenna delay
@@ -66,6 +67,155 @@ def calc_weights(freqs, delay):
 
     return np.exp(-1j * phase)
 
+class Weight_Engine(object):
+    """Computes beamforming delays and weights for many targets at once.
+
+    The antenna geometry is fixed when the engine is built. Delays for every
+    antenna and target come from a single matrix product, and weights are
+    produced a block of channels at a time, so memory stays bounded by
+    n_antennas x n_targets x chunk regardless of the number of channels.
+
+    Examples:
+        >>> engine = Weight_Engine(ant_pos, chunk = 256)
+        >>> tau = engine.delays(p_az, p_alt, az, alt)
+        >>> w = engine.weights(freqs, tau)
+        >>> for chans, block in engine.iter_weights(freqs, tau):
+        ...     send(chans, block)
+    """
+    c = 3e8
+
+    def __init__(self, ant_pos, chunk = 256, dtype = np.complex64, n_threads = None):
+        """
+        Args:
+            ant_pos: (np.ndarray)
+                Antenna positions of shape (N_antennas x 3), defined from some
+                reference antenna/point
+            chunk: (int)
+                Number of channels computed per block
+            dtype: (np.dtype)
+                Weight dtype, np.complex64 or np.complex128
+            n_threads: (int)
+                Number of threads sharing each block. NumPy releases the GIL
+                while computing, so blocks scale across cores. Defaults to 1.
+        """
+        self.ant_pos = np.ascontiguousarray(np.atleast_2d(ant_pos), dtype = np.float64)
+        self.chunk = int(chunk)
+        self.dtype = np.dtype(dtype)
+        self.n_threads = max(1, int(n_threads or 1))
+        self._pool = ThreadPoolExecutor(self.n_threads) if self.n_threads > 1 else None
+
+    @property
+    def n_ant(self):
+        return self.ant_pos.shape[0]
+
+    def delays(self, p_az, p_alt, az, alt):
+        """Calculates the delays of every antenna towards every target relative
+        to the array pointing
+
+        Args:
+            p_az: (float)
+                Azimuth of the array pointing in radians
+            p_alt: (float)
+                Altitude of the array pointing in radians
+            az: (float, np.ndarray)
+                Target azimuths in radians
+            alt: (float, np.ndarray)
+                Target altitudes in radians
+
+        Returns:
+            tau: (np.ndarray)
+                Delays in seconds with shape (N_antennas x N_targets)
+        """
+        az = np.atleast_1d(np.asarray(az, dtype = np.float64))
+        alt = np.atleast_1d(np.asarray(alt, dtype = np.float64))
+        s = np.stack([np.cos(az) * np.cos(alt), np.sin(az) * np.cos(alt),
+                      np.sin(alt)])
+        p = np.array([np.cos(p_az) * np.cos(p_alt), np.sin(p_az) * np.cos(p_alt),
+                      np.sin(p_alt)])
+        return np.dot(self.ant_pos, s - p[:, np.newaxis]) / self.c
+
+    def weights(self, freqs, delay, out = None):
+        """Calculates the complex weights for every channel
+
+        Args:
+            freqs: (np.ndarray)
+                Channel frequencies in Hz
+            delay: (np.ndarray)
+                Delays from Weight_Engine.delays with shape
+                (N_antennas x N_targets)
+            out: (np.ndarray)
+                Optional complex array of shape
+                (N_antennas x N_targets x N_channels) to write into
+
+        Returns:
+            out: (np.ndarray)
+                Weights exp(-2 pi i f tau)
+        """
+        freqs = np.atleast_1d(np.asarray(freqs, dtype = np.float64))
+        delay = np.asarray(delay, dtype = np.float64)
+        shape = delay.shape + freqs.shape
+        if out is None:
+            out = np.empty(shape, dtype = self.dtype)
+        elif out.shape != shape:
+            raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+
+        phase = np.empty(delay.shape + (min(self.chunk, freqs.shape[0]),))
+        for start in range(0, freqs.shape[0], self.chunk):
+            stop = min(start + self.chunk, freqs.shape[0])
+            self._fill(freqs[start:stop], delay, out[..., start:stop],
+                       phase[..., :stop - start])
+        return out
+
+    def iter_weights(self, freqs, delay, out = None):
+        """Yields the weights one block of channels at a time. The same buffer
+        is reused for every block, so copy it if it must outlive the iteration.
+
+        Args:
+            freqs: (np.ndarray)
+                Channel frequencies in Hz
+            delay: (np.ndarray)
+                Delays from Weight_Engine.delays with shape
+                (N_antennas x N_targets)
+            out: (np.ndarray)
+                Optional complex buffer of shape
+                (N_antennas x N_targets x chunk) to reuse
+
+        Yields:
+            chans: (slice)
+                Channels covered by the block
+            block: (np.ndarray)
+                Weights of shape (N_antennas x N_targets x block size)
+        """
+        freqs = np.atleast_1d(np.asarray(freqs, dtype = np.float64))
+        delay = np.asarray(delay, dtype = np.float64)
+        if out is None:
+            out = np.empty(delay.shape + (self.chunk,), dtype = self.dtype)
+        phase = np.empty(out.shape)
+
+        step = out.shape[-1]
+        for start in range(0, freqs.shape[0], step):
+            stop = min(start + step, freqs.shape[0])
+            block = out[..., :stop - start]
+            self._fill(freqs[start:stop], delay, block, phase[..., :stop - start])
+            yield slice(start, stop), block
+
+    def _fill(self, freqs, delay, block, phase):
+        """Writes exp(-2 pi i f tau) for one block of channels, splitting the
+        antennas between threads
+        """
+        def work(a, b):
+            np.multiply(delay[a:b, ..., np.newaxis], 2.0 * np.pi * freqs,
+                        out = phase[a:b])
+            np.cos(phase[a:b], out = block.real[a:b])
+            np.sin(phase[a:b], out = block.imag[a:b])
+            np.negative(block.imag[a:b], out = block.imag[a:b])
+
+        if self._pool is None:
+            work(0, delay.shape[0])
+        else:
+            edges = np.linspace(0, delay.shape[0], self.n_threads + 1).astype(int)
+            list(self._pool.map(work, edges[:-1], edges[1:]))
+
 def transform_to_az_alt(source, times):
     """Transform from ra/dec coordinates to alt/az coordinates from MeerKATs perspective
 
@@ -90,8 +240,161 @@ def transform_to_az_alt(source, times):
     frame = source.transform_to(meerkat_frame)
     return frame
 
+class AltAz_Transformer(object):
+    """Fast ICRS to AltAz transform for sources near one pointing.
+
+    The exact astropy transform is run once, on a coarse time grid, for a set
+    of reference directions around the pointing. At each grid time a 3x3
+    matrix mapping ICRS unit vectors onto AltAz unit vectors is fitted. With
+    the Earth's rotation taken out analytically these matrices vary slowly,
+    so they are interpolated in time and any number of sources and times can
+    be transformed with a matrix product. The interpolation error is checked
+    against the exact transform between grid points when the transformer is
+    built, and the grid is refined until it is within tolerance.
+
+    Examples:
+        >>> tf = AltAz_Transformer(pointing, start, stop, radius = np.deg2rad(1))
+        >>> az, alt = tf.transform(ra, dec, times)
+    """
+    # Sidereal rate of the Earth rotation angle in radians per second
+    rotation_rate = 2.0 * np.pi * 1.00273781191135448 / 86400.0
+
+    def __init__(self, pointing, start, stop, radius, grid_step = 300.0,
+                 tolerance = 0.05, max_refinements = 6):
+        """
+        Args:
+            pointing: (astropy.coordinates.SkyCoord)
+                Centre of the field
+            start, stop: (astropy.time.Time)
+                Time range the transformer will be used over
+            radius: (float)
+                Radius of the field in radians. Sources outside it are
+                transformed less accurately.
+            grid_step: (float)
+                Initial spacing of the exact transforms in seconds
+            tolerance: (float)
+                Maximum allowed error in arcseconds
+            max_refinements: (int)
+                Number of times the grid step may be halved to meet tolerance
+        """
+        self.t0 = start
+        self.span = max((stop - start).sec, 0.0)
+        self.tolerance = tolerance
+        pointing = pointing.icrs
+        self.refs = _ring_vectors(pointing.ra.rad, pointing.dec.rad, radius)
+        checks = _ring_vectors(pointing.ra.rad, pointing.dec.rad, 0.7 * radius,
+                               n = 5, offset = 0.5)
+
+        for _ in range(max_refinements + 1):
+            n_grid = max(2, int(np.ceil(self.span / grid_step)) + 1)
+            self.grid = np.linspace(0.0, self.span, n_grid)
+            self._fit()
+
+            mid = 0.5 * (self.grid[:-1] + self.grid[1:])
+            exact = _exact_altaz(checks, self.t0 + mid * u.s)
+            approx = self._apply(checks, mid)
+            cos_err = np.clip(np.sum(exact * approx, axis = -1), -1.0, 1.0)
+            self.max_error = np.rad2deg(np.arccos(cos_err).max()) * 3600.0
+
+            if self.max_error <= tolerance:
+                break
+            grid_step /= 2.0
+
+        else:
+            raise ValueError('AltAz interpolation error {:.3g} arcsec exceeds '
+                             'tolerance of {} arcsec'.format(self.max_error,
+                                                             tolerance))
+
+    def _fit(self):
+        """Fits the slowly varying part of the ICRS to AltAz matrix at every
+        grid time
+        """
+        exact = _exact_altaz(self.refs, self.t0 + self.grid * u.s)
+        # M^T = pinv(S) A at every grid time
+        m_t = np.einsum('ik,tkj->tij', np.linalg.pinv(self.refs), exact)
+        self._b = np.einsum('tji,tjk->tik', m_t, _rot_z(self.rotation_rate * self.grid))
+
+    def _matrices(self, dt):
+        """Returns the ICRS to AltAz matrices at times dt (seconds from start)
+        """
+        dt = np.atleast_1d(np.asarray(dt, dtype = np.float64))
+        i = np.clip(np.searchsorted(self.grid, dt) - 1, 0, self.grid.shape[0] - 2)
+        w = ((dt - self.grid[i]) / (self.grid[i + 1] - self.grid[i]))[:, None, None]
+        b = self._b[i] * (1.0 - w) + self._b[i + 1] * w
+        return np.einsum('tij,tjk->tik', b, _rot_z(-self.rotation_rate * dt))
+
+    def _apply(self, vecs, dt):
+        """Maps ICRS unit vectors (N x 3) to AltAz unit vectors (T x N x 3)"""
+        aa = np.einsum('tij,nj->tni', self._matrices(dt), vecs)
+        return aa / np.linalg.norm(aa, axis = -1)[..., np.newaxis]
+
+    def transform(self, ra, dec, times):
+        """Transforms source coordinates to azimuth and altitude
+
+        Args:
+            ra, dec: (float, np.ndarray)
+                Source coordinates in radians
+            times: (astropy.time.Time)
+                Observation time(s)
+
+        Returns:
+            az: (np.ndarray)
+                Azimuth in radians with shape (N_times x N_sources)
+            alt: (np.ndarray)
+                Altitude in radians with shape (N_times x N_sources)
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype = np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype = np.float64))
+        vecs = np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra),
+                         np.sin(dec)], axis = -1)
+
+        aa = self._apply(vecs, np.atleast_1d((times - self.t0).sec))
+        az = np.arctan2(aa[..., 1], aa[..., 0]) % (2.0 * np.pi)
+        alt = np.arcsin(np.clip(aa[..., 2], -1.0, 1.0))
+        return az, alt
+
+def _rot_z(angle):
+    """Returns rotation matrices about the z axis with shape (N x 3 x 3)"""
+    angle = np.atleast_1d(angle)
+    c, s = np.cos(angle), np.sin(angle)
+    rot = np.zeros(angle.shape + (3, 3))
+    rot[:, 0, 0], rot[:, 0, 1] = c, -s
+    rot[:, 1, 0], rot[:, 1, 1] = s, c
+    rot[:, 2, 2] = 1.0
+    return rot
+
+def _ring_vectors(ra, dec, radius, n = 8, offset = 0.0):
+    """Returns ICRS unit vectors for a direction and two rings around it"""
+    x0 = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    east = np.array([-np.sin(ra), np.cos(ra), 0.0])
+    north = np.cross(x0, east)
+    angle = 2.0 * np.pi * (np.arange(n) + offset) / n
+    vecs = [x0]
+    for r in [radius, 0.5 * radius]:
+        ring = (np.cos(r) * x0 + np.sin(r) * (np.cos(angle)[:, None] * east +
+                                              np.sin(angle)[:, None] * north))
+        vecs.extend(ring)
+    return np.array(vecs)
+
+def _exact_altaz(vecs, times):
+    """Exact astropy transform of ICRS unit vectors (N x 3) at times (T),
+    returned as AltAz unit vectors (T x N x 3)
+    """
+    ra = np.arctan2(vecs[:, 1], vecs[:, 0])
+    dec = np.arcsin(np.clip(vecs[:, 2], -1.0, 1.0))
+    source = SkyCoord(ra = ra * u.rad, dec = dec * u.rad, frame = 'icrs')
+    frame = AltAz(obstime = times[:, np.newaxis], location = _meerkat_location())
+    aa = source[np.newaxis, :].transform_to(frame)
+    az, alt = aa.az.rad, aa.alt.rad
+    return np.stack([np.cos(alt) * np.cos(az), np.cos(alt) * np.sin(az),
+                     np.sin(alt)], axis = -1)
+
+_MEERKAT_LOCATION = None
+
 def _meerkat_location():
-    meerkat_pos = (-30.721111, 21.411111)
-    loc_meerkat = EarthLocation(lat = meerkat_pos[0]*u.deg,
-                                lon = meerkat_pos[1]*u.deg)
-    return loc_meerkat
+    global _MEERKAT_LOCATION
+    if _MEERKAT_LOCATION is None:
+        meerkat_pos = (-30.721111, 21.411111)
+        _MEERKAT_LOCATION = EarthLocation(lat = meerkat_pos[0]*u.deg,
+                                          lon = meerkat_pos[1]*u.deg)
+    return _MEERKAT_LOCATION
@@ -0,0 +1,230 @@
+import json
+import numpy as np
+from astropy import units as u
+
+try:
+    from .logger import log as logger
+    from .redis_tools import write_pair_redis, publish
+
+except ImportError:
+    from logger import log as logger
+    from redis_tools import write_pair_redis, publish
+
+class Delay_Model(object):
+    """Polynomial model of beamforming delays over a validity window.
+
+    Delays are sampled from an exact delay function across the window and a
+    polynomial in time (delay, rate, acceleration, ...) is fitted for every
+    antenna and target with one least squares solve. Downstream users only
+    need the published coefficients and evaluate them with Horner's scheme.
+    The model is refitted when a time falls outside the window or when a
+    spot check against the exact delays exceeds the residual threshold.
+
+    Examples:
+        >>> model = Delay_Model(delay_func, window = 60.0, order = 2)
+        >>> tau = model.delays(t)
+        >>> model.check(t)
+    """
+    def __init__(self, delay_func, window = 60.0, order = 2, n_samples = None,
+                 threshold = 1e-12):
+        """
+        Args:
+            delay_func: (callable)
+                Function of an array of times in seconds returning the exact
+                delays with shape (N_times x N_antennas x N_targets)
+            window: (float)
+                Length of the validity window in seconds
+            order: (int)
+                Polynomial order. 2 fits delay, rate and acceleration.
+            n_samples: (int)
+                Number of exact delay evaluations per fit. Defaults to order + 3
+            threshold: (float)
+                Maximum allowed difference from the exact delays in seconds
+                before a refit is triggered
+        """
+        self.delay_func = delay_func
+        self.window = float(window)
+        self.order = int(order)
+        self.n_samples = int(n_samples or self.order + 3)
+        self.threshold = threshold
+        self.coeffs = None
+        self.t_ref = None
+        self.t_start = None
+        self.residual = None
+        self.n_fits = 0
+
+    @classmethod
+    def from_pointing(cls, engine, transformer, p_ra, p_dec, ra, dec, epoch, **kwargs):
+        """Builds a model from mk_delay's Weight_Engine and AltAz_Transformer
+
+        Args:
+            engine: (mk_delay.Weight_Engine)
+                Engine holding the antenna geometry
+            transformer: (mk_delay.AltAz_Transformer)
+                Transformer built for the pointing
+            p_ra, p_dec: (float)
+                Array pointing in radians
+            ra, dec: (np.ndarray)
+                Target coordinates in radians
+            epoch: (astropy.time.Time)
+                Time that model times (in seconds) are measured from
+
+        Returns:
+            model: (Delay_Model)
+        """
+        def delay_func(t):
+            times = epoch + np.atleast_1d(t) * u.s
+            p_az, p_alt = transformer.transform(p_ra, p_dec, times)
+            az, alt = transformer.transform(ra, dec, times)
+            return np.array([engine.delays(p_az[i, 0], p_alt[i, 0], az[i], alt[i])
+                             for i in range(len(times))])
+
+        return cls(delay_func, **kwargs)
+
+    def fit(self, t_start):
+        """Fits the polynomial over [t_start, t_start + window]
+
+        Args:
+            t_start: (float)
+                Start of the validity window in seconds
+
+        Returns:
+            residual: (float)
+                Largest difference between the fit and the sampled delays
+        """
+        self.t_start = float(t_start)
+        self.t_ref = self.t_start + 0.5 * self.window
+
+        # Chebyshev nodes keep the fit well behaved at the window edges
+        k = np.arange(self.n_samples)
+        x = np.cos(np.pi * (k + 0.5) / self.n_samples)[::-1] * 0.5 * self.window
+        samples = np.asarray(self.delay_func(self.t_ref + x))
+        shape = samples.shape[1:]
+
+        vander = np.vander(x, self.order + 1, increasing = True)
+        flat = samples.reshape(self.n_samples, -1)
+        coeffs = np.linalg.lstsq(vander, flat, rcond = None)[0]
+
+        self.coeffs = coeffs.reshape((self.order + 1,) + shape)
+        self.residual = float(np.abs(np.dot(vander, coeffs) - flat).max())
+        self.n_fits += 1
+
+        if self.residual > self.threshold:
+            logger.warning('Delay model residual {:.3g} s exceeds threshold of '
+                           '{:.3g} s'.format(self.residual, self.threshold))
+        return self.residual
+
+    def valid(self, t):
+        """Returns True if every time lies within the validity window"""
+        if self.coeffs is None:
+            return False
+        t = np.asarray(t, dtype = np.float64)
+        return bool(np.all((t >= self.t_start) & (t <= self.t_start + self.window)))
+
+    def evaluate(self, t):
+        """Evaluates the polynomial with Horner's scheme
+
+        Args:
+            t: (float, np.ndarray)
+                Time(s) in seconds
+
+        Returns:
+            tau: (np.ndarray)
+                Delays with shape (N_antennas x N_targets), or
+                (N_times x N_antennas x N_targets) for an array of times
+        """
+        dt = np.asarray(t, dtype = np.float64) - self.t_ref
+        dt = dt.reshape(dt.shape + (1,) * (self.coeffs.ndim - 1))
+        tau = self.coeffs[self.order] * np.ones_like(dt)
+        for c in self.coeffs[-2::-1]:
+            tau = tau * dt + c
+        return tau
+
+    def delays(self, t):
+        """Returns the modelled delays, refitting if t is outside the window
+
+        Args:
+            t: (float, np.ndarray)
+                Time(s) in seconds
+
+        Returns:
+            tau: (np.ndarray)
+                Delays in seconds
+        """
+        if not self.valid(t):
+            self.fit(np.min(t))
+        return self.evaluate(t)
+
+    def check(self, t):
+        """Compares the model with the exact delays at time t and refits from t
+        if the difference is above the threshold
+
+        Args:
+            t: (float)
+                Time in seconds
+
+        Returns:
+            refit: (bool)
+                True if the model was refitted
+        """
+        if self.valid(t):
+            error = np.abs(self.evaluate(t) - self.delay_func(np.atleast_1d(t))[0]).max()
+            if error <= self.threshold:
+                return False
+            logger.info('Delay model error {:.3g} s at t = {}. Refitting'.format(
+                        error, t))
+
+        self.fit(t)
+        return True
+
+    def to_dict(self):
+        """Returns the model in a JSON serialisable form
+
+        Returns:
+            model: (dict)
+                Reference time, validity window and coefficients. Coefficient k
+                multiplies (t - t_ref) ** k.
+        """
+        return {'t_ref': self.t_ref, 't_start': self.t_start,
+                't_stop': self.t_start + self.window, 'order': self.order,
+                'shape': list(self.coeffs.shape[1:]),
+                'coeffs': self.coeffs.tolist()}
+
+    def publish(self, server, key, channel = 'bluse:///set'):
+        """Writes the coefficients to redis and announces them on a channel
+
+        Args:
+            server: (redis.StrictRedis)
+                a redis-py redis server object
+            key: (str)
+                Key to store the coefficients under
+            channel: (str)
+                Channel to publish the key on
+
+        Returns:
+            True if the model was written and published
+        """
+        if not write_pair_redis(server, key, json.dumps(self.to_dict())):
+            return False
+        return publish(server, channel, key)
+
+def evaluate_dict(model, t):
+    """Evaluates a published model (see Delay_Model.to_dict) at time(s) t
+
+    Args:
+        model: (dict)
+            Decoded model
+        t: (float, np.ndarray)
+            Time(s) in seconds
+
+    Returns:
+        tau: (np.ndarray)
+            Delays in seconds
+    """
+    coeffs = np.asarray(model['coeffs'], dtype = np.float64)
+    dt = np.asarray(t, dtype = np.float64) - model['t_ref']
+    dt = dt.reshape(dt.shape + (1,) * (coeffs.ndim - 1))
+    tau = coeffs[-1] * np.ones_like(dt)
+    for c in coeffs[-2::-1]:
+        tau = tau * dt + c
+    return tau
@@ -0,0 +1,188 @@
+import time
+import zlib
+import queue
+import threading
+
+try:
+    from .logger import log as logger
+
+except ImportError:
+    from logger import log as logger
+
+class Dispatcher(object):
+    """
+    Hands messages read from Redis to a pool of worker threads so the pubsub
+    reader never waits on a handler. Each worker has its own queue and every
+    message is routed by a hash of its product_id, so messages for one
+    subarray are handled in order while different subarrays run in parallel.
+    Queue depth, queueing delay and per-handler service times are recorded.
+
+    Messages submitted with a coalesce key are latest-value-wins: a newer
+    message with the same key supersedes an older one that is still queued,
+    which is then dropped and counted instead of being handled.
+
+    Examples:
+        >>> dispatcher = Dispatcher(n_workers = 4)
+        >>> dispatcher.submit(product_id, func, message, label = 'target')
+        >>> dispatcher.stats()
+    """
+    def __init__(self, n_workers = 4, maxsize = 0, name = 'dispatch'):
+        """
+        __init__ function for the Dispatcher class
+
+        Parameters:
+            n_workers: (int)
+                Number of worker threads
+            maxsize: (int)
+                Maximum number of queued messages per worker. submit blocks
+                while the queue is full. 0 means unbounded.
+            name: (str)
+                Prefix of the worker thread names
+
+        Returns:
+            None
+        """
+        self.n_workers = max(int(n_workers), 1)
+        self.queues = [queue.Queue(maxsize = maxsize) for _ in range(self.n_workers)]
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self._seq = 0
+        self._latest = {}
+        self._dropped = {}
+        self._wait = [0, 0.0, 0.0]
+        self._service = {}
+        self._lock = threading.Lock()
+
+        self.workers = []
+        for i, q in enumerate(self.queues):
+            worker = threading.Thread(target = self._work, args = (q,),
+                                      name = '{}-{}'.format(name, i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queues func(*args) on the worker that owns key
+
+        Parameters:
+            key: (str)
+                Ordering key, normally the product_id. Calls with the same key
+                run one at a time in submission order.
+            func: (callable)
+                Handler to run
+            args:
+                Arguments passed to func
+            label: (str)
+                Name the service time is recorded under. Defaults to the
+                name of func
+            coalesce: (hashable)
+                Calls sharing this key replace each other while queued; only
+                the latest one is run. None queues the call unconditionally.
+
+        Returns:
+            None
+        """
+        label = kwargs.pop('label', None) or getattr(func, '__name__', str(func))
+        coalesce = kwargs.pop('coalesce', None)
+        q = self.queues[zlib.crc32(str(key).encode()) % self.n_workers]
+
+        with self._lock:
+            self.submitted += 1
+            self._seq += 1
+            seq = self._seq
+            if coalesce is not None:
+                if coalesce in self._latest:
+                    self.dropped += 1
+                    self._dropped[label] = self._dropped.get(label, 0) + 1
+                self._latest[coalesce] = seq
+
+        q.put((time.time(), seq, coalesce, label, func, args, kwargs))
+
+    def _work(self, q):
+        """Worker loop. Runs queued calls until a None sentinel is received
+        """
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+
+            queued, seq, coalesce, label, func, args, kwargs = item
+            if coalesce is not None:
+                with self._lock:
+                    superseded = self._latest.get(coalesce) != seq
+                    if not superseded:
+                        del self._latest[coalesce]
+                if superseded:
+                    q.task_done()
+                    continue
+
+            start = time.time()
+            try:
+                func(*args, **kwargs)
+                failed = 0
+            except Exception as e:
+                logger.error('Handler {} failed: {}'.format(label, e))
+                failed = 1
+            stop = time.time()
+            q.task_done()
+
+            with self._lock:
+                self.completed += 1
+                self.failed += failed
+                self._wait[0] += 1
+                self._wait[1] += start - queued
+                self._wait[2] = max(self._wait[2], start - queued)
+                service = self._service.setdefault(label, [0, 0.0, 0.0])
+                service[0] += 1
+                service[1] += stop - start
+                service[2] = max(service[2], stop - start)
+
+    def depth(self):
+        """Returns the number of messages waiting to be handled"""
+        return sum(q.qsize() for q in self.queues)
+
+    def join(self):
+        """Blocks until every queued message has been handled"""
+        for q in self.queues:
+            q.join()
+
+    def stop(self, wait = True):
+        """Stops the workers once the messages already queued are handled
+
+        Parameters:
+            wait: (bool)
+                Block until the workers have exited
+
+        Returns:
+            None
+        """
+        for q in self.queues:
+            q.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def stats(self):
+        """Returns the queue and timing statistics
+
+        Returns:
+            stats: (dict)
+                Queue depth, message counters, the mean and maximum time in
+                seconds messages waited in the queue, the count, mean and
+                maximum service time of each handler, and the number of
+                superseded messages dropped for each handler
+        """
+        def _summary(values):
+            count, total, longest = values
+            return {'count': count, 'mean': total / count if count else 0.0,
+                    'max': longest}
+
+        with self._lock:
+            return {'depth': self.depth(), 'submitted': self.submitted,
+                    'completed': self.completed, 'failed': self.failed,
+                    'dropped': self.dropped, 'dropped_by_label': dict(self._dropped),
+                    'wait': _summary(self._wait),
+                    'service': {k: _summary(v) for k, v in self._service.items()}}
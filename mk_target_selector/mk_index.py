@@ -0,0 +1,295 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    from .logger import log as logger
+    from . import sky_tools
+
+except ImportError:
+    from logger import log as logger
+    import sky_tools
+
+# Version of the on-disk snapshot layout written by Sky_Index.save
+SNAPSHOT_VERSION = 1
+
+# Modulus applied to source_id in Sky_Index.table_checksum
+CHECKSUM_MODULUS = 1000000007
+
+class Sky_Index(object):
+    """
+    In-memory spatial index over the source catalog. Sources are stored as unit
+    vectors sorted by their HEALPix cell id, so a cone search is a handful of
+    binary searches over the cells that touch the beam followed by a chord
+    length test on the candidates.
+
+    Examples:
+        >>> index = Sky_Index.from_sql(conn)
+        >>> index.select_targets(c_ra, c_dec, beam_rad)
+    """
+    def __init__(self, columns, cell_order = sky_tools.CELL_ORDER):
+        """
+        __init__ function for the Sky_Index class
+
+        Parameters:
+            columns: (dict, pandas.DataFrame)
+                Catalog columns. Must contain 'ra' and 'decl' in degrees.
+            cell_order: (int)
+                HEALPix order of the cell ids used to sort the catalog
+
+        Returns:
+            None
+        """
+        columns = {c: np.asarray(columns[c]) for c in columns}
+        ra = np.deg2rad(columns['ra'])
+        dec = np.deg2rad(columns['decl'])
+        cell = sky_tools.ang2pix(cell_order, ra, dec)
+        order = np.argsort(cell, kind = 'mergesort')
+
+        self.cell_order = cell_order
+        self.cols = list(columns.keys())
+        self.columns = {c: columns[c][order] for c in self.cols}
+        self.cell = cell[order]
+        self.x, self.y, self.z = [v[order] for v in sky_tools.radec_to_vec(ra, dec)]
+
+    @classmethod
+    def load(cls, path, mmap_mode = 'r'):
+        """Memory-maps an index snapshot written by Sky_Index.save
+
+        Parameters:
+            path: (str)
+                Snapshot directory
+            mmap_mode: (str, None)
+                Passed to numpy.load. None reads the arrays into memory.
+
+        Returns:
+            index: (Sky_Index)
+        """
+        manifest = read_manifest(path)
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {} in {}'.format(
+                             manifest.get('version'), path))
+
+        def _load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode)
+
+        index = cls.__new__(cls)
+        index.cell_order = manifest['cell_order']
+        index.cols = manifest['columns']
+        index.columns = {c: _load('col_' + c) for c in index.cols}
+        index.cell = _load('cell')
+        index.x, index.y, index.z = _load('x'), _load('y'), _load('z')
+        index.manifest = manifest
+        return index
+
+    def save(self, path, checksum = None):
+        """Writes the index as one .npy file per column plus a manifest, so it
+        can be memory-mapped by Sky_Index.load
+
+        Parameters:
+            path: (str)
+                Snapshot directory. Created if it does not exist.
+            checksum: (dict)
+                Database checksum stored in the manifest and compared against
+                at load time
+
+        Returns:
+            None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        for c in self.cols:
+            values = self.columns[c]
+            if values.dtype == object:
+                values = values.astype(str)
+            np.save(os.path.join(path, 'col_' + c + '.npy'), values)
+
+        for name in ['cell', 'x', 'y', 'z']:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+        manifest = {'version': SNAPSHOT_VERSION, 'cell_order': self.cell_order,
+                    'columns': self.cols, 'rows': len(self),
+                    'checksum': checksum}
+
+        # Write the manifest last so a partial snapshot is never loaded
+        tmp = os.path.join(path, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, os.path.join(path, 'manifest.json'))
+
+    @classmethod
+    def from_sql(cls, conn, table = 'target_list',
+                 cols = ['ra', 'decl', 'source_id', 'Project']):
+        """Loads a table from the database and builds the index
+
+        Parameters:
+            conn: SQLalchemy engine or connection
+                SQLalchemy connection to a database
+            table: (str)
+                Name of the table containing the catalog
+            cols: (list)
+                Columns to load into memory
+
+        Returns:
+            index: (Sky_Index)
+        """
+        query = 'SELECT {} FROM {}'.format(', '.join(cols), table)
+        tb = pd.read_sql(query, con = conn)
+        logger.info('Building spatial index over {} sources'.format(tb.shape[0]))
+        return cls(tb)
+
+    @staticmethod
+    def table_checksum(conn, table = 'target_list'):
+        """Returns a cheap checksum of the catalog table used to check that a
+        snapshot is still current
+
+        Parameters:
+            conn: SQLalchemy engine or connection
+                SQLalchemy connection to a database
+            table: (str)
+                Name of the table containing the catalog
+
+        Returns:
+            checksum: (dict)
+                Row count, sum of source_id modulo a prime and largest source_id.
+                The modulo keeps the sum from overflowing 64-bit integers on
+                catalogs with large (e.g. Gaia) source_id values.
+        """
+        # SQLite has no MOD function without its math extension, while '%'
+        # would be taken as a parameter marker by the MySQL drivers
+        if getattr(getattr(conn, 'dialect', None), 'name', None) == 'sqlite':
+            id_mod = 'source_id % {}'.format(CHECKSUM_MODULUS)
+        else:
+            id_mod = 'MOD(source_id, {})'.format(CHECKSUM_MODULUS)
+        query = 'SELECT COUNT(*) AS n_rows, SUM({}) AS id_sum, \
+                 MAX(source_id) AS id_max FROM {}'.format(id_mod, table)
+        row = pd.read_sql(query, con = conn).iloc[0]
+        id_sum, id_max = row['id_sum'], row['id_max']
+        return {'rows': int(row['n_rows']),
+                'id_sum': None if pd.isnull(id_sum) else int(id_sum),
+                'id_max': None if pd.isnull(id_max) else int(id_max)}
+
+    def __len__(self):
+        return self.cell.shape[0]
+
+    def candidates(self, c_ra, c_dec, beam_rad):
+        """Returns the positions of sources in cells that overlap the beam
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            idx: (np.ndarray)
+                Positions within the sorted catalog arrays
+        """
+        ranges = sky_tools.disc_ranges(c_ra, c_dec, beam_rad, self.cell_order)
+        lo = np.searchsorted(self.cell, ranges[:, 0], side = 'left')
+        hi = np.searchsorted(self.cell, ranges[:, 1], side = 'left')
+        keep = hi > lo
+        if not keep.any():
+            return np.empty(0, dtype = np.int64)
+        return np.concatenate([np.arange(a, b) for a, b in zip(lo[keep], hi[keep])])
+
+    def cone(self, c_ra, c_dec, beam_rad):
+        """Returns the positions and squared chord distances of sources within
+        the beam
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            idx: (np.ndarray)
+                Positions within the sorted catalog arrays
+            chord2: (np.ndarray)
+                Squared chord length between each source and the pointing
+        """
+        idx = self.candidates(c_ra, c_dec, beam_rad)
+        x0, y0, z0 = sky_tools.radec_to_vec(c_ra, c_dec)
+        chord2 = ((self.x[idx] - x0) ** 2 + (self.y[idx] - y0) ** 2 +
+                  (self.z[idx] - z0) ** 2)
+        inside = chord2 < sky_tools.chord_radius(beam_rad)
+        return idx[inside], chord2[inside]
+
+    def to_frame(self, idx, chord2):
+        """Builds the target table for a set of catalog positions
+
+        Parameters:
+            idx: (np.ndarray)
+                Positions within the sorted catalog arrays
+            chord2: (np.ndarray)
+                Squared chord length between each source and the pointing
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns plus the angular separation from the pointing
+                in radians
+        """
+        tb = pd.DataFrame({c: self.columns[c][idx] for c in self.cols},
+                          columns = self.cols)
+        tb['separation'] = sky_tools.chord_to_angle(chord2)
+        return tb
+
+    def select_targets(self, c_ra, c_dec, beam_rad):
+        """Returns the sources within some primary beam area
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns plus the angular separation from the pointing
+                in radians
+        """
+        return self.to_frame(*self.cone(c_ra, c_dec, beam_rad))
+
+    def select_targets_many(self, pointings, beam_rad):
+        """Returns the sources within the primary beam of several pointings
+
+        Parameters:
+            pointings: (list)
+                List of (c_ra, c_dec) pointing coordinates in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns, the angular separation from the pointing in
+                radians and the position of the pointing within pointings
+        """
+        c_ra, c_dec = np.asarray(pointings, dtype = np.float64).reshape(-1, 2).T
+        idx = [self.candidates(r, d, beam_rad) for r, d in zip(c_ra, c_dec)]
+        pointing = np.repeat(np.arange(len(idx)), [i.shape[0] for i in idx])
+        idx = np.concatenate(idx) if idx else np.empty(0, dtype = np.int64)
+
+        x0, y0, z0 = sky_tools.radec_to_vec(c_ra[pointing], c_dec[pointing])
+        chord2 = ((self.x[idx] - x0) ** 2 + (self.y[idx] - y0) ** 2 +
+                  (self.z[idx] - z0) ** 2)
+        inside = chord2 < sky_tools.chord_radius(beam_rad)
+
+        tb = self.to_frame(idx[inside], chord2[inside])
+        tb['pointing'] = pointing[inside]
+        return tb
+
+def read_manifest(path):
+    """Reads the manifest of an index snapshot
+
+    Parameters:
+        path: (str)
+            Snapshot directory
+
+    Returns:
+        manifest: (dict)
+    """
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        return json.load(f)
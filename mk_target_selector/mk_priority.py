@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+class Priority_Scorer(object):
+    """
+    Computes a priority score for every source in a field of view. Lower
+    scores are observed first. The score is a weighted sum of the observation
+    history, the source's project and its distance from the beam centre:
+
+        priority = 1 + observed * w_observed + n_obs * w_n_obs
+                     + duration [h] * w_duration + separation [deg] * w_separation
+                     + project weight
+
+    Sources on the allow list always get priority 0 and sources on the deny
+    list are removed. With the default weights the score is 1 for new sources
+    and 2 for sources that have been observed before. Scores are integers
+    whenever every weight in use is a whole number, as with the defaults, and
+    floats otherwise.
+
+    Examples:
+        >>> scorer = Priority_Scorer(cfg.get('priority', {}))
+        >>> tb = scorer.score(tb, observed, n_obs, duration)
+    """
+    def __init__(self, cfg = None):
+        """
+        __init__ function for the Priority_Scorer class
+
+        Parameters:
+            cfg: (dict)
+                The priority section of config.yml. Recognised keys are
+                observed, n_obs, duration, separation, project (mapping of
+                project name to weight), allow and deny (lists of source_id)
+
+        Returns:
+            None
+        """
+        cfg = cfg or {}
+        self.w_observed = float(cfg.get('observed', 1.0))
+        self.w_n_obs = float(cfg.get('n_obs', 0.0))
+        self.w_duration = float(cfg.get('duration', 0.0))
+        self.w_separation = float(cfg.get('separation', 0.0))
+        self.project = dict(cfg.get('project', {}) or {})
+        self.allow = np.unique(np.asarray(cfg.get('allow', []) or [], dtype = np.int64))
+        self.deny = np.unique(np.asarray(cfg.get('deny', []) or [], dtype = np.int64))
+
+        # Duration and separation terms are fractional, the others stay whole
+        # numbers if their weights are
+        self.integral = not self.w_duration and not self.w_separation and \
+                        all(float(w).is_integer() for w in
+                            [self.w_observed, self.w_n_obs] + list(self.project.values()))
+
+    def score(self, tb, observed, n_obs, duration):
+        """Adds the priority column to a table of sources
+
+        Parameters:
+            tb: (pandas.DataFrame)
+                Sources within the field of view. A separation column (radians)
+                and a Project column are used when present.
+            observed: (np.ndarray)
+                True where the source has been observed before
+            n_obs: (np.ndarray)
+                Number of previous observations of each source
+            duration: (np.ndarray)
+                Total duration of previous observations in seconds
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Table with the priority column, without denied sources
+        """
+        source_ids = tb['source_id'].values.astype(np.int64)
+
+        priority = 1.0 + self.w_observed * np.asarray(observed, dtype = np.float64)
+
+        if self.w_n_obs:
+            priority += self.w_n_obs * np.asarray(n_obs, dtype = np.float64)
+
+        if self.w_duration:
+            priority += self.w_duration * np.asarray(duration, dtype = np.float64) / 3600.0
+
+        if self.w_separation and 'separation' in tb:
+            priority += self.w_separation * np.rad2deg(tb['separation'].values)
+
+        if self.project and 'Project' in tb:
+            codes, projects = pd.factorize(tb['Project'])
+            weights = np.array([self.project.get(p, 0.0) for p in projects] + [0.0],
+                               dtype = np.float64)
+            # Missing projects have code -1, which picks the trailing 0.0
+            priority += weights[codes]
+
+        if self.allow.shape[0]:
+            priority[_isin_sorted(source_ids, self.allow)] = 0.0
+
+        tb['priority'] = priority.astype(np.int64) if self.integral else priority
+
+        if self.deny.shape[0]:
+            tb = tb[~_isin_sorted(source_ids, self.deny)]
+
+        return tb
+
+def _isin_sorted(values, sorted_ids):
+    """Returns a mask marking the values present in a sorted, unique array
+    """
+    pos = np.minimum(np.searchsorted(sorted_ids, values), sorted_ids.shape[0] - 1)
+    return sorted_ids[pos] == values
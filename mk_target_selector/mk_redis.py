@@ -1,5 +1,5 @@
+import os
 import re
-import json
 import yaml
 import time
 import threading
@@ -11,19 +11,25 @@ from astropy.coordinates import Angle, SkyCoord
 try:
     from .logger import log as logger
     from .mk_db import Triage
-    from .redis_tools import (publish,
-                              get_redis_key,
-                              write_pair_redis,
+    from .mk_dispatch import Dispatcher
+    from .mk_writer import Write_Behind
+    from .payload_tools import encode_targets, encode_delta, diff_targets, SUFFIXES
+    from .redis_tools import (get_redis_key,
                               connect_to_redis,
+                              write_and_publish,
+                              unlink_registry,
                               delete_key)
 
 except ImportError:
     from logger import log as logger
     from mk_db import Triage
-    from redis_tools import (publish,
-                             get_redis_key,
-                             write_pair_redis,
+    from mk_dispatch import Dispatcher
+    from mk_writer import Write_Behind
+    from payload_tools import encode_targets, encode_delta, diff_targets, SUFFIXES
+    from redis_tools import (get_redis_key,
                              connect_to_redis,
+                             write_and_publish,
+                             unlink_registry,
                              delete_key)
 
 class Listen(threading.Thread):
@@ -70,7 +76,24 @@ class Listen(threading.Thread):
         self.engine = Triage()
 
         self.sensor_info = {}
-
+        self._deltas = {}
+        self._init_actions()
+        self.writer = self._init_writer(chan)
+
+        # Handlers run on a worker pool so slow ones do not block the pubsub
+        # reader. workers: 0 handles messages inline.
+        dispatch = self.engine.cfg.get('dispatch', {})
+        n_workers = dispatch.get('workers', 4)
+        self.dispatcher = Dispatcher(n_workers, dispatch.get('maxsize', 0)) \
+                          if n_workers else None
+
+        # Sensors whose queued updates are superseded by newer ones
+        self.coalesce = set(dispatch.get('coalesce', ['target']) or [])
+
+    def _init_actions(self):
+        """Sets up the tables that map channels, alerts and sensors to their
+           handlers
+        """
         self.channel_actions = {
             'alerts': self._alerts,
             'sensor_alerts': self._sensor_alerts,
@@ -83,24 +106,58 @@ class Listen(threading.Thread):
             'capture-init': self._pass,
             'capture-start': self._pass,
             'capture-stop': self._pass,
-            'capture-done': self._pass
+            'capture-done': self._pass,
+            'targets-snapshot': self._targets_snapshot
         }
 
         self.sensor_actions = {
             'data_suspect': self._data_suspect,
             'schedule_blocks': self._pass,
             'pool_resources': self._pool_resources,
+            'band': self._band,
             'observation_status': self._status_update,
-            'target': self._target
+            'target': self._target_coords
         }
 
+    def _init_writer(self, chan):
+        """Returns the write-behind queue for observation bookkeeping, or None
+           if write_behind.enabled is false in config.yml. The journal path is
+           suffixed with the channels so listeners never share a journal.
+        """
+        cfg = dict(self.engine.cfg.get('write_behind', {}) or {})
+        if not cfg.pop('enabled', True):
+            return None
+
+        chan = [chan] if isinstance(chan, str) else list(chan)
+        root, ext = os.path.splitext(cfg.get('journal', 'write_behind.journal'))
+        cfg['journal'] = '{}.{}{}'.format(root, re.sub(r'[^\w.-]', '_', '-'.join(chan)), ext)
+        return Write_Behind(self.engine, **cfg)
+
+    def stop(self):
+        """Handles the messages already queued, writes the pending
+           observation bookkeeping and closes the database connections and
+           catalog search. Called on shutdown.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.writer is not None:
+            self.writer.stop()
+        self.engine.close_conn()
+
     def run(self):
         """Runs continuously to listen for messages that come in from specific
            redis channels. Main function that handles the processing of the
            messages that come through redis.
         """
         for item in self.p.listen():
-            self._message_to_func(item['channel'], self.channel_actions)(item['data'])
+            channel, data = item['channel'], item['data']
+            func = self._message_to_func(channel, self.channel_actions)
+            if self.dispatcher is None:
+                func(data)
+            else:
+                self.dispatcher.submit(self._message_product(channel, data), func,
+                                       data, label = self._message_label(channel, data),
+                                       coalesce = self._coalesce_key(channel, data))
 
     """
 
@@ -142,7 +199,12 @@ class Listen(threading.Thread):
                                         'targets': [], 'pool_resources': ''}
 
     def _deconfigure(self, product_id):
-        """Response to deconfigure message from the redis alerts channel
+        """Response to deconfigure message from the redis alerts channel.
+           Removes every key the target selector wrote for the subarray, as
+           recorded in its key registry. Keys written by other processes are
+           only removed for the sensors listed in deconfigure.scan (by
+           default processing, as before the registry), which scans the whole
+           keyspace.
 
         Parameters:
             item: (str)
@@ -151,14 +213,17 @@ class Listen(threading.Thread):
         Returns:
             None
         """
-        sensor_list = ['processing', 'targets']
+        n = unlink_registry(self.redis_server, self._registry_key(product_id))
+        logger.info('Deconfigure message. Removed {} keys for {}'.format(n, product_id))
 
-        for sensor in sensor_list:
+        for sensor in self.engine.cfg.get('deconfigure', {}).get('scan', ['processing']) or []:
             key_glob = '{}:*:{}'.format(product_id, sensor)
             for k in self.redis_server.scan_iter(key_glob):
                 logger.info('Deconfigure message. Removing key: {}'.format(k))
                 delete_key(self.redis_server, k)
 
+        self._deltas.pop(product_id, None)
+
         # TODO: update the database with information inside the sensor_info
         try:
             del self.sensor_info[product_id]
@@ -188,12 +253,15 @@ class Listen(threading.Thread):
         if sensor.endswith('pool_resources'):
             sensor = 'pool_resources'
 
+        elif sensor.endswith('_band'):
+            sensor = 'band'
+
         if product_id not in self.sensor_info.keys():
             self._configure(product_id)
 
         self._message_to_func(sensor, self.sensor_actions)(message)
 
-    def _target(self, message):
+    def _target_coords(self, message):
         """Response to message from the Sensor Alerts channel. If both the right
         ascension and declination are stored, then the database is queried
         for
@@ -215,7 +283,7 @@ class Listen(threading.Thread):
             p_num = self.sensor_info[product_id]['pointings']
             self.sensor_info[product_id][sensor] = coords
             targets = self.engine.select_targets(coords.ra.rad, coords.dec.rad,
-                                                 beam_rad = np.deg2rad(0.5))
+                                                 beam_rad = self._beam_radius(product_id))
             self.sensor_info[product_id]['pointings'] += 1
             self.sensor_info[product_id]['targets'].append(targets)
             self._publish_targets(targets, product_id = product_id,
@@ -246,11 +314,12 @@ class Listen(threading.Thread):
             target_pointing = schedule_block['targets']
 
         start = time.time()
-        for i, t in enumerate(target_pointing):
-            targets = self.engine.select_targets(*self.pointing_coords(t),
-                                                  beam_rad = np.deg2rad(0.5))
+        pointings = [self.pointing_coords(t) for t in target_pointing]
+        target_lists = self.engine.select_targets_many(pointings,
+                                                       beam_rad = self._beam_radius(product_id))
+        for i, targets in enumerate(target_lists):
             self.sensor_info[product_id]['pointing_{}'.format(i)] = targets
-            self._publish_targets(targets, product_id = product_id, sub_arr_id = i)
+        self._publish_many(target_lists, product_id = product_id)
 
         logger.info('{} pointings processed in {} seconds'.format(len(target_pointing),
                                                              time.time() - start))
@@ -289,6 +358,24 @@ class Listen(threading.Thread):
         self.sensor_info[product_id]['pool_resources'] = value
 
 
+    def _band(self, message):
+        """Response to a band message from the sensor_alerts channel. Stores the
+        receiver band of the subarray and clears its cached beam radius.
+
+        Parameters:
+            message: (str)
+                Message passed over sensor_alerts channels. Acts as the key to
+                query Redis in the case of this function.
+
+        Returns:
+            None
+        """
+        product_id, _ = message.split(':')
+        value = get_redis_key(self.redis_server, message)
+        self.sensor_info[product_id]['band'] = value
+        self.sensor_info[product_id].pop('beam_rad', None)
+
+
     """
 
     Internal Methods
@@ -341,6 +428,63 @@ class Listen(threading.Thread):
         """
         return action.get(channel, self._other)
 
+    def _message_product(self, channel, data):
+        """Returns the product_id a message refers to, which decides the order
+           messages are handled in
+
+        Parameters:
+            channel: (str)
+                Channel the message arrived on
+            data: (str)
+                Message passed over the channel
+
+        Returns:
+            product_id: (str)
+        """
+        parts = str(data).split(':')
+        if channel == 'alerts' and len(parts) > 1:
+            return parts[1]
+        return parts[0]
+
+    def _message_label(self, channel, data):
+        """Returns the alert or sensor name of a message, used to label
+           handler timings
+
+        Parameters:
+            channel: (str)
+                Channel the message arrived on
+            data: (str)
+                Message passed over the channel
+
+        Returns:
+            label: (str)
+        """
+        parts = str(data).split(':')
+        if channel == 'alerts' or len(parts) < 2:
+            return '{}:{}'.format(channel, parts[0])
+        return '{}:{}'.format(channel, parts[1])
+
+    def _coalesce_key(self, channel, data):
+        """Returns the key under which a message replaces older queued
+           messages, or None if every message must be handled
+
+        Parameters:
+            channel: (str)
+                Channel the message arrived on
+            data: (str)
+                Message passed over the channel
+
+        Returns:
+            key: (tuple, None)
+                (product_id, sensor) for sensors listed in dispatch.coalesce
+        """
+        if channel != 'sensor_alerts':
+            return None
+        parts = str(data).split(':')
+        if len(parts) > 1 and parts[1] in self.coalesce:
+            return (parts[0], parts[1])
+        return None
+
     def _other(self, channel):
         """Function that handles unrecognized requests from redis server
 
@@ -365,7 +509,10 @@ class Listen(threading.Thread):
         """
         status_msg = self.load_schedule_block(msg)
         if status_msg['success']:
-            self.engine.update_obs_status(**status_msg)
+            if self.writer is None:
+                self.engine.update_obs_status(**status_msg)
+            else:
+                self.writer.update_status(**status_msg)
 
     def _unsubscribe(self, channels = None):
         """Unsubscribe from the redis server
@@ -397,31 +544,60 @@ class Listen(threading.Thread):
         # TODO: Change this to handle specific pointing in subarray
         targets = self.sensor_info[product_id]['targets'][0]
 
-        # TODO: query frequency band sensor
-        bands = 'L BAND'
+        bands = self.sensor_info[product_id].get('band') or 'L BAND'
 
         # TODO: ask Daniel/Dave about unique file-id
         file_id = 'filler_file_id'
-        self.engine.add_sources_to_db(targets, start, end, proxies, antennas,
-                                      file_id, bands)
+        if self.writer is None:
+            self.engine.add_sources_to_db(targets, start, end, proxies, antennas,
+                                          file_id, bands)
+        else:
+            self.writer.add_sources(targets, start, end, proxies, antennas,
+                                    file_id, bands)
 
-    def _beam_radius(self, product_id, dish_size = 13.5):
+    def _beam_radius(self, product_id, dish_size = None):
         """Returns the beam radius based on the frequency band used in the
-           observation
+           observation. The radius is half the primary beam FWHM,
+           fwhm_factor * wavelength / dish_size, at the centre of the band, and
+           is cached per product_id until the band changes.
 
        Parameters:
             product_id: (str)
                 product ID for the given sub-array
+            dish_size: (float)
+                Dish diameter in metres. Defaults to beam.dish_size in
+                config.yml or 13.5
 
         Returns:
             beam_rad: (float)
                 Radius of the beam in radians
         """
-        # TODO: change this to the real name
-        sensor_name = 'max_freq'
-        key = '{}:{}'.format(product_id, sensor_name)
-        max_freq = get_redis_key(self.redis_server, key)
-        return (2.998e8 / max_freq) / dish_size
+        # Never create the entry here; its presence marks the product as
+        # configured
+        info = self.sensor_info.get(product_id, {})
+        if 'beam_rad' in info:
+            return info['beam_rad']
+
+        cfg = self.engine.cfg.get('beam', {})
+        dish_size = dish_size or cfg.get('dish_size', 13.5)
+        beam_rad = np.deg2rad(cfg.get('default_radius', 0.5))
+
+        band = info.get('band')
+        if band is None:
+            band = self._get_sensor_value(product_id,
+                                          cfg.get('band_sensor', 'subarray_1_band'))
+
+        freq = band_centre_freq(band)
+        if freq is None:
+            logger.warning('Unknown band {} for {}. Using a beam radius of {} '
+                           'rad'.format(band, product_id, beam_rad))
+        else:
+            beam_rad = 0.5 * cfg.get('fwhm_factor', 1.22) * (2.998e8 / freq) / dish_size
+
+        if product_id in self.sensor_info:
+            info['band'] = band
+            info['beam_rad'] = beam_rad
+        return beam_rad
 
     def _publish_targets(self, targets, product_id, sub_arr_id = 0, sensor_name = 'targets',
                          columns = ['ra', 'decl', 'priority'] , channel = 'bluse:///set'):
@@ -438,11 +614,128 @@ class Listen(threading.Thread):
         Returns:
             None
         """
-        targ_dict = targets.loc[:, columns].to_dict('list')
-        key = '{}:pointing_{}:{}'.format(product_id, sub_arr_id, sensor_name)
-        write_pair_redis(self.redis_server, key, json.dumps(targ_dict))
-        publish(self.redis_server, channel, key)
-        logger.info('Targets published to {}'.format(channel))
+        self._publish_many([targets], product_id, first_id = sub_arr_id,
+                           sensor_name = sensor_name, columns = columns,
+                           channel = channel)
+
+    def _publish_many(self, target_lists, product_id, first_id = 0, sensor_name = 'targets',
+                      columns = ['ra', 'decl', 'priority'], channel = 'bluse:///set'):
+        """Writes the target lists of several pointings and publishes their keys
+           in one pipelined transaction. Keys expire after publish.ttl seconds
+           in config.yml if it is set. publish.format selects the encoding
+           (json, binary or msgpack, see payload_tools), which is announced by
+           the key suffix. With publish.delta set, only the changes since the
+           previous list are published (see _delta_pairs).
+
+        Parameters:
+            target_lists: (list)
+                Target tables (pandas.DataFrame), one per pointing
+            product_id: (str)
+                product ID for the given sub-array
+            first_id: (int)
+                Pointing number of the first table
+
+        Returns:
+            None
+        """
+        cfg = self.engine.cfg.get('publish', {})
+        fmt = cfg.get('format', 'json')
+        float_dtype = cfg.get('float_dtype', '<f8')
+
+        if cfg.get('delta'):
+            pairs = self._delta_pairs(target_lists, product_id, first_id, sensor_name,
+                                      columns, fmt, float_dtype,
+                                      cfg.get('snapshot_interval', 20))
+        else:
+            pairs = []
+            for i, targets in enumerate(target_lists):
+                key = '{}:pointing_{}:{}{}'.format(product_id, first_id + i, sensor_name,
+                                                   SUFFIXES[fmt])
+                pairs.append((key, encode_targets(targets, columns, fmt, float_dtype)))
+
+        ttl = cfg.get('ttl')
+        if write_and_publish(self.redis_server, pairs, channel, expiration = ttl,
+                             registry = self._registry_key(product_id)):
+            logger.info('Targets for {} pointing(s) published to {}'.format(len(pairs),
+                                                                         channel))
+        elif product_id in self._deltas:
+            # Readers may have missed a delta, so start again from a snapshot
+            self._deltas[product_id]['ids'] = None
+
+    def _delta_pairs(self, target_lists, product_id, first_id, sensor_name, columns,
+                     fmt, float_dtype, snapshot_interval):
+        """Builds the product_id:pointing_N:targets_delta key-value pairs for a
+           sequence of target lists. Each value holds a sequence number, the
+           sequence number it applies to, the added or re-prioritised sources
+           and the source_id of removed ones. The first list, every
+           snapshot_interval-th list and any list after a targets-snapshot
+           request are sent in full, with a base of None.
+
+        Parameters:
+            target_lists: (list)
+                Target tables (pandas.DataFrame), one per pointing
+            product_id: (str)
+                product ID for the given sub-array
+            first_id: (int)
+                Pointing number of the first table
+            snapshot_interval: (int)
+                Number of deltas between full snapshots
+
+        Returns:
+            pairs: (list)
+                (key, value) pairs in publication order
+        """
+        state = self._deltas.setdefault(product_id, {'seq': 0, 'ids': None,
+                                                     'priority': None, 'since_full': 0})
+        columns = ['source_id'] + [c for c in columns if c != 'source_id']
+
+        pairs = []
+        for i, targets in enumerate(target_lists):
+            full = state['ids'] is None or state['since_full'] >= snapshot_interval
+            if full:
+                old_ids, old_priority = np.empty(0, dtype = np.int64), np.empty(0)
+            else:
+                old_ids, old_priority = state['ids'], state['priority']
+
+            changed, removed, ids, priority = diff_targets(old_ids, old_priority, targets)
+            state['seq'] += 1
+            base = None if full else state['seq'] - 1
+            state['since_full'] = 0 if full else state['since_full'] + 1
+            state.update(ids = ids, priority = priority,
+                         last = (first_id + i, sensor_name, targets))
+
+            key = '{}:pointing_{}:{}_delta{}'.format(product_id, first_id + i,
+                                                     sensor_name, SUFFIXES[fmt])
+            pairs.append((key, encode_delta(state['seq'], base, changed, removed,
+                                            columns, fmt, float_dtype)))
+        return pairs
+
+    def _registry_key(self, product_id):
+        """Returns the name of the set recording the keys written for a
+           subarray
+        """
+        return '{}:target_selector:keys'.format(product_id)
+
+    def _targets_snapshot(self, product_id):
+        """Response to a targets-snapshot message from the alerts channel.
+           Republishes the last target list of a subarray as a full snapshot.
+
+        Parameters:
+            product_id: (str)
+                product ID for the given sub-array
+
+        Returns:
+            None
+        """
+        state = self._deltas.get(product_id)
+        if state is None or 'last' not in state:
+            logger.info('No targets published for {} yet'.format(product_id))
+            return
+
+        pointing, sensor_name, targets = state['last']
+        state['ids'] = None
+        self._publish_many([targets], product_id, first_id = pointing,
+                           sensor_name = sensor_name)
 
 
     def pointing_coords(self, t_str):
@@ -508,6 +801,39 @@ class Listen(threading.Thread):
         notify_slack()
 
 
+# Frequency ranges (Hz) of the MeerKAT receiver bands
+BANDS = {
+    'u': (544e6, 1088e6),
+    'l': (856e6, 1712e6),
+    's': (1750e6, 3500e6),
+    'x': (8e9, 14.5e9)
+}
+
+def band_centre_freq(band):
+    """Returns the centre frequency of a receiver band
+
+    Parameters:
+        band: (str)
+            Band name such as 'l' or 'L BAND', or a frequency in Hz
+
+    Returns:
+        freq: (float, None)
+            Centre frequency in Hz, or None if the band is not recognised
+    """
+    if band is None:
+        return None
+
+    try:
+        freq = float(band)
+        return freq if freq > 0 else None
+    except ValueError:
+        pass
+
+    key = str(band).strip().lower().split(' ')[0]
+    if key in BANDS:
+        return 0.5 * sum(BANDS[key])
+    return None
+
 def str_to_bool(value):
     """Returns a boolean value corresponding to
 
@@ -0,0 +1,269 @@
+import os
+import threading
+import multiprocessing
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+try:
+    from .logger import log as logger
+    from . import sky_tools
+
+except ImportError:
+    from logger import log as logger
+    import sky_tools
+
+# Geometry arrays of Sky_Index placed in shared memory
+SHARED = ['cell', 'x', 'y', 'z']
+
+# Arrays and segments attached by a worker process, see _attach
+_arrays = {}
+_segments = []
+
+# Search service shared by every Triage of the process, see shared_search
+_service = None
+_service_lock = threading.Lock()
+
+def shared_search(load, n_workers = None, n_shards = None, min_batch = 16):
+    """Returns the process-wide Shard_Search, building it the first time so
+    that listeners in one process share a single pool and one copy of the
+    catalog. Every caller must close() it once.
+
+    Parameters:
+        load: (callable)
+            Returns the Sky_Index. Only called when the service is built
+        n_workers, n_shards, min_batch:
+            See Shard_Search
+
+    Returns:
+        search: (Shard_Search)
+    """
+    global _service
+    with _service_lock:
+        if _service is None or _service.pool is None:
+            _service = Shard_Search(load(), n_workers, n_shards, min_batch)
+        else:
+            _service.refs += 1
+        return _service
+
+class Shard_Search(object):
+    """
+    Cone search over a Sky_Index spread across a pool of worker processes. The
+    cell-sorted geometry arrays are copied once into shared memory and split
+    into shards of consecutive cells, i.e. sky regions. A request is fanned out
+    to the shards its cell ranges touch; workers read the shared arrays in
+    place and send back only the positions and distances of the matches, which
+    are merged and turned into a table from the index's columns. The index
+    keeps searching the shared arrays in place of its own, so the geometry is
+    held once, and requests with fewer than min_batch pointings are searched
+    in-process because they cost less than a round trip to the pool.
+
+    Requires Python 3.8 or later for multiprocessing.shared_memory.
+
+    Examples:
+        >>> search = Shard_Search(Sky_Index.from_sql(conn), n_workers = 8)
+        >>> search.select_targets_many(pointings, beam_rad)
+        >>> search.close()
+    """
+    def __init__(self, index, n_workers = None, n_shards = None, min_batch = 16):
+        """
+        __init__ function for the Shard_Search class
+
+        Parameters:
+            index: (Sky_Index)
+                Index holding the catalog
+            n_workers: (int)
+                Number of worker processes. Defaults to the number of cores
+            n_shards: (int)
+                Number of sky regions the catalog is split into. Defaults to
+                four per worker
+            min_batch: (int)
+                Smallest number of pointings sent to the pool
+
+        Returns:
+            None
+        """
+        if shared_memory is None:
+            raise ImportError('Shard_Search requires multiprocessing.shared_memory '
+                              '(Python 3.8 or later)')
+
+        self.index = index
+        self.cell_order = index.cell_order
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.min_batch = min_batch
+        self.refs = 1
+        n_shards = max(int(n_shards or 4 * self.n_workers), 1)
+
+        self._segments = []
+        specs = {}
+        for name in SHARED:
+            values = np.ascontiguousarray(getattr(index, name))
+            shm = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+            shared = np.ndarray(values.shape, dtype = values.dtype, buffer = shm.buf)
+            shared[:] = values
+            # The index searches the shared copy so its own can be freed
+            setattr(index, name, shared)
+            self._segments.append(shm)
+            specs[name] = (shm.name, values.shape, values.dtype.str)
+        del values, shared
+
+        n = len(index)
+        bounds = np.linspace(0, n, n_shards + 1).astype(np.int64)
+        self.shards = [(lo, hi) for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist())
+                       if hi > lo]
+        # First and last cell id of every shard, for routing requests
+        self.shard_cells = np.array([(index.cell[lo], index.cell[hi - 1])
+                                     for lo, hi in self.shards], dtype = np.int64)
+
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(self.n_workers, initializer = _attach,
+                                 initargs = (specs,))
+        logger.info('Sharded {} sources into {} regions over {} processes'.format(
+                    n, len(self.shards), self.n_workers))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def select_targets(self, c_ra, c_dec, beam_rad):
+        """Returns the sources within some primary beam area
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns plus the angular separation from the pointing
+                in radians
+        """
+        return self.index.select_targets(c_ra, c_dec, beam_rad)
+
+    def select_targets_many(self, pointings, beam_rad):
+        """Returns the sources within the primary beam of several pointings
+
+        Parameters:
+            pointings: (list)
+                List of (c_ra, c_dec) pointing coordinates in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns, the angular separation from the pointing in
+                radians and the position of the pointing within pointings
+        """
+        c_ra, c_dec = np.asarray(pointings, dtype = np.float64).reshape(-1, 2).T
+        if c_ra.shape[0] < self.min_batch:
+            return self.index.select_targets_many(pointings, beam_rad)
+
+        ranges = self._ranges(c_ra, c_dec, beam_rad)
+        limit = sky_tools.chord_radius(beam_rad)
+
+        tasks = []
+        for (lo, hi), (first, last) in zip(self.shards, self.shard_cells):
+            todo = [p for p, r in enumerate(ranges) if r.shape[0] and
+                    np.any((r[:, 0] <= last) & (r[:, 1] > first))]
+            if todo:
+                tasks.append((lo, hi, [ranges[p] for p in todo],
+                              c_ra[todo], c_dec[todo], np.array(todo), limit))
+
+        results = self.pool.map(_search, tasks) if tasks else []
+        if results:
+            idx, chord2, pointing = [np.concatenate(r) for r in zip(*results)]
+        else:
+            idx, chord2 = np.empty(0, dtype = np.int64), np.empty(0)
+            pointing = np.empty(0, dtype = np.int64)
+
+        order = np.lexsort((idx, pointing))
+        tb = self.index.to_frame(idx[order], chord2[order])
+        tb['pointing'] = pointing[order]
+        return tb
+
+    def _ranges(self, c_ra, c_dec, beam_rad):
+        """Returns the cell ranges covering every pointing, computed by the
+        workers when there are more pointings than workers
+        """
+        if c_ra.shape[0] <= self.n_workers:
+            return [sky_tools.disc_ranges(r, d, beam_rad, self.cell_order)
+                    for r, d in zip(c_ra, c_dec)]
+
+        chunks = np.array_split(np.arange(c_ra.shape[0]), self.n_workers)
+        tasks = [(c_ra[c], c_dec[c], beam_rad, self.cell_order) for c in chunks]
+        return [r for part in self.pool.map(_disc_ranges, tasks) for r in part]
+
+    def close(self):
+        """Releases the search. The last close stops the workers and frees the
+        shared memory, after which the index can no longer be searched.
+        """
+        with _service_lock:
+            self.refs -= 1
+            if self.refs > 0 or self.pool is None:
+                return
+
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            for name in SHARED:
+                setattr(self.index, name, np.empty(0, dtype = getattr(self.index, name).dtype))
+            for shm in self._segments:
+                shm.close()
+                shm.unlink()
+            self._segments = []
+
+def _attach(specs):
+    """Worker initializer. Maps the shared geometry arrays without copying"""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name = shm_name)
+        _segments.append(shm)
+        _arrays[name] = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+def _disc_ranges(task):
+    """Worker function returning the cell ranges of a group of pointings"""
+    c_ra, c_dec, beam_rad, cell_order = task
+    return [sky_tools.disc_ranges(r, d, beam_rad, cell_order) for r, d in zip(c_ra, c_dec)]
+
+def _search(task):
+    """Worker function searching one shard for several pointings
+
+    Returns:
+        idx: (np.ndarray)
+            Positions of the matches in the sorted catalog
+        chord2: (np.ndarray)
+            Squared chord distance of each match from its pointing
+        pointing: (np.ndarray)
+            Pointing each match belongs to
+    """
+    lo, hi, ranges, c_ra, c_dec, pointings, limit = task
+    cell = _arrays['cell'][lo:hi]
+    out_idx, out_chord2, out_pointing = [], [], []
+    for r, ra, dec, p in zip(ranges, c_ra, c_dec, pointings):
+        a = np.searchsorted(cell, r[:, 0], side = 'left')
+        b = np.searchsorted(cell, r[:, 1], side = 'left')
+        keep = b > a
+        if not keep.any():
+            continue
+        idx = np.concatenate([np.arange(i, j) for i, j in zip(a[keep], b[keep])]) + lo
+        x0, y0, z0 = sky_tools.radec_to_vec(ra, dec)
+        chord2 = ((_arrays['x'][idx] - x0) ** 2 + (_arrays['y'][idx] - y0) ** 2 +
+                  (_arrays['z'][idx] - z0) ** 2)
+        inside = chord2 < limit
+        out_idx.append(idx[inside])
+        out_chord2.append(chord2[inside])
+        out_pointing.append(np.full(int(inside.sum()), p, dtype = np.int64))
+
+    if not out_idx:
+        return (np.empty(0, dtype = np.int64), np.empty(0),
+                np.empty(0, dtype = np.int64))
+    return (np.concatenate(out_idx), np.concatenate(out_chord2),
+            np.concatenate(out_pointing))
@@ -0,0 +1,398 @@
+import os
+import json
+import pickle
+import shutil
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+try:
+    from .logger import log as logger
+    from . import sky_tools
+
+except ImportError:
+    from logger import log as logger
+    import sky_tools
+
+# Version of the on-disk layout written by Tile_Catalog.build
+TILES_VERSION = 1
+
+# Per-source arrays stored in every tile next to the catalog columns
+SPATIAL = ['_cell', '_x', '_y', '_z']
+
+# Prefix of the optional per-column null masks stored in a tile
+NULL_PREFIX = '_null_'
+
+class Tile_Catalog(object):
+    """
+    Out-of-core catalog partitioned into HEALPix tiles. Each tile is a single
+    file holding its columns back to back, sorted by cell id, and a small
+    manifest records the rows, dtypes and offsets of every tile. A cone search
+    memory-maps only the tiles that overlap the beam, and the most recently
+    used tiles stay mapped, so query cost and resident memory depend on the
+    beam and the working set rather than on the size of the catalog.
+
+    Examples:
+        >>> Tile_Catalog.build('/data/tiles', pd.read_csv(path, chunksize = 10**6))
+        >>> catalog = Tile_Catalog('/data/tiles')
+        >>> catalog.select_targets(c_ra, c_dec, beam_rad)
+    """
+    def __init__(self, path, max_tiles = 64):
+        """
+        __init__ function for the Tile_Catalog class
+
+        Parameters:
+            path: (str)
+                Directory written by Tile_Catalog.build
+            max_tiles: (int)
+                Number of tiles kept memory-mapped
+
+        Returns:
+            None
+        """
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != TILES_VERSION:
+            raise ValueError('Unsupported tile catalog version {} in {}'.format(
+                             manifest.get('version'), path))
+
+        self.path = path
+        self.manifest = manifest
+        self.cols = manifest['columns']
+        self.tile_order = manifest['tile_order']
+        self.cell_order = manifest['cell_order']
+        self.tiles = {int(t): v for t, v in manifest['tiles'].items()}
+        self.max_tiles = max_tiles
+        self.hits = 0
+        self.misses = 0
+        self._mapped = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(t['rows'] for t in self.tiles.values())
+
+    @classmethod
+    def build(cls, path, chunks, tile_order = 5, cell_order = sky_tools.CELL_ORDER,
+              string_width = None, buffer_rows = 4000000):
+        """Partitions a catalog into tiles. Rows are buffered per tile across
+        chunks and appended to one staging file per tile whenever buffer_rows
+        rows are buffered, then each tile is sorted and written out, so memory
+        use is bounded by the buffer and tile sizes.
+
+        Text columns are stored as fixed-width strings sized to the longest
+        value in each tile. Missing values are recorded in a null mask next to
+        the column and read back as None (text) or NaN.
+
+        Parameters:
+            path: (str)
+                Output directory. Created if it does not exist.
+            chunks: (iterable)
+                pandas.DataFrame chunks of the catalog with 'ra' and 'decl' in
+                degrees, for example pd.read_csv(..., chunksize = N)
+            tile_order: (int)
+                HEALPix order of the tiles
+            cell_order: (int)
+                HEALPix order of the cell ids sorting sources within a tile
+            string_width: (int)
+                Maximum length of text values. Longer values raise ValueError.
+                None does not limit the length.
+            buffer_rows: (int)
+                Number of rows buffered before the staging files are written
+
+        Returns:
+            catalog: (Tile_Catalog)
+        """
+        staging = os.path.join(path, 'staging')
+        if not os.path.isdir(staging):
+            os.makedirs(staging)
+
+        shift = 2 * (cell_order - tile_order)
+        columns = None
+        dtypes = {}
+        buffers = {}
+        buffered = 0
+        n = 0
+        for chunk in chunks:
+            if columns is None:
+                columns = list(chunk.columns)
+            ra = np.deg2rad(np.asarray(chunk['ra'], dtype = np.float64))
+            dec = np.deg2rad(np.asarray(chunk['decl'], dtype = np.float64))
+            cell = sky_tools.ang2pix(cell_order, ra, dec)
+
+            for c in columns:
+                # A column that is text in any chunk is stored as text
+                dtype = _storage_dtype(chunk[c])
+                if c not in dtypes or dtype == 'text':
+                    dtypes[c] = dtype
+
+            chunk = chunk.loc[:, columns].copy()
+            chunk['_cell'] = cell
+            chunk['_x'], chunk['_y'], chunk['_z'] = sky_tools.radec_to_vec(ra, dec)
+
+            tile = cell >> shift
+            order = np.argsort(tile, kind = 'mergesort')
+            chunk = chunk.take(order)
+            tiles, starts = np.unique(tile[order], return_index = True)
+            stops = np.append(starts[1:], order.shape[0])
+            for t, a, b in zip(tiles.tolist(), starts, stops):
+                buffers.setdefault(t, []).append(chunk.iloc[a:b])
+
+            n += order.shape[0]
+            buffered += order.shape[0]
+            if buffered >= buffer_rows:
+                _flush(staging, buffers)
+                buffered = 0
+            logger.info('Partitioned {} sources'.format(n))
+        _flush(staging, buffers)
+
+        manifest = {'version': TILES_VERSION, 'tile_order': tile_order,
+                    'cell_order': cell_order, 'columns': columns or [],
+                    'rows': n, 'tiles': {}}
+
+        for name in sorted(os.listdir(staging), key = lambda f: int(f.split('.')[0])):
+            t = int(name.split('.')[0])
+            tb = _read_staged(os.path.join(staging, name))
+            order = np.argsort(tb['_cell'].values, kind = 'mergesort')
+            arrays = _tile_arrays(tb, columns, dtypes, string_width)
+            manifest['tiles'][str(t)] = _write_tile(_tile_file(path, t), arrays, order)
+            os.remove(os.path.join(staging, name))
+
+        shutil.rmtree(staging)
+
+        # Write the manifest last so a partial catalog is never loaded
+        tmp = os.path.join(path, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, os.path.join(path, 'manifest.json'))
+        return cls(path)
+
+    def _tile(self, t):
+        """Returns the mapped arrays of a tile, mapping it if necessary and
+        unmapping the least recently used tile when the LRU is full
+        """
+        with self._lock:
+            arrays = self._mapped.get(t)
+            if arrays is not None:
+                self._mapped.move_to_end(t)
+                self.hits += 1
+                return arrays
+
+            self.misses += 1
+            info = self.tiles[t]
+            raw = np.memmap(_tile_file(self.path, t), dtype = np.uint8, mode = 'r')
+            arrays = {}
+            for name, dtype, offset in info['columns']:
+                dtype = np.dtype(dtype)
+                arrays[name] = np.frombuffer(raw, dtype = dtype, count = info['rows'],
+                                             offset = offset)
+
+            self._mapped[t] = arrays
+            while len(self._mapped) > self.max_tiles:
+                self._mapped.popitem(last = False)
+            return arrays
+
+    def cone(self, c_ra, c_dec, beam_rad):
+        """Returns the sources within the beam, tile by tile
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            parts: (list)
+                (arrays, idx, chord2) for every tile with sources in the beam
+        """
+        ranges = sky_tools.disc_ranges(c_ra, c_dec, beam_rad, self.cell_order)
+        if ranges.shape[0] == 0:
+            return []
+
+        shift = 2 * (self.cell_order - self.tile_order)
+        tiles = np.unique(np.concatenate([np.arange(a >> shift, ((b - 1) >> shift) + 1)
+                                          for a, b in ranges]))
+        x0, y0, z0 = sky_tools.radec_to_vec(c_ra, c_dec)
+        limit = sky_tools.chord_radius(beam_rad)
+
+        parts = []
+        for t in tiles.tolist():
+            if t not in self.tiles:
+                continue
+            arrays = self._tile(t)
+            cell = arrays['_cell']
+            lo = np.searchsorted(cell, ranges[:, 0], side = 'left')
+            hi = np.searchsorted(cell, ranges[:, 1], side = 'left')
+            keep = hi > lo
+            if not keep.any():
+                continue
+            idx = np.concatenate([np.arange(a, b) for a, b in zip(lo[keep], hi[keep])])
+            chord2 = ((arrays['_x'][idx] - x0) ** 2 + (arrays['_y'][idx] - y0) ** 2 +
+                      (arrays['_z'][idx] - z0) ** 2)
+            inside = chord2 < limit
+            if inside.any():
+                parts.append((arrays, idx[inside], chord2[inside]))
+        return parts
+
+    def select_targets(self, c_ra, c_dec, beam_rad):
+        """Returns the sources within some primary beam area
+
+        Parameters:
+            c_ra, c_dec: (float)
+                Pointing coordinates of the telescope in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns plus the angular separation from the pointing
+                in radians
+        """
+        parts = self.cone(c_ra, c_dec, beam_rad)
+        tb = pd.DataFrame({c: _column_values(parts, c) if parts
+                           else np.empty(0, dtype = _column_dtype(self, c))
+                           for c in self.cols}, columns = self.cols)
+        chord2 = np.concatenate([d for _, _, d in parts]) if parts else np.empty(0)
+        tb['separation'] = sky_tools.chord_to_angle(chord2)
+        return tb
+
+    def select_targets_many(self, pointings, beam_rad):
+        """Returns the sources within the primary beam of several pointings
+
+        Parameters:
+            pointings: (list)
+                List of (c_ra, c_dec) pointing coordinates in radians
+            beam_rad: (float)
+                Angular radius of the primary beam in radians
+
+        Returns:
+            tb: (pandas.DataFrame)
+                Catalog columns, the angular separation from the pointing in
+                radians and the position of the pointing within pointings
+        """
+        c_ra, c_dec = np.asarray(pointings, dtype = np.float64).reshape(-1, 2).T
+        tbs = []
+        for i, (r, d) in enumerate(zip(c_ra, c_dec)):
+            tb = self.select_targets(r, d, beam_rad)
+            tb['pointing'] = i
+            tbs.append(tb)
+        if not tbs:
+            tb = self.select_targets(0.0, 0.0, 0.0).iloc[:0]
+            tb['pointing'] = np.empty(0, dtype = np.int64)
+            return tb
+        return pd.concat(tbs, ignore_index = True)
+
+    def stats(self):
+        """Returns the tile LRU counters
+
+        Returns:
+            stats: (dict)
+                Number of hits, misses and mapped tiles
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'mapped': len(self._mapped)}
+
+def _tile_file(path, t):
+    """Returns the file name of a tile"""
+    return os.path.join(path, 'tile_{}.bin'.format(t))
+
+def _storage_dtype(values):
+    """Returns the on-disk dtype of a catalog column, or 'text'"""
+    kind = np.asarray(values).dtype.kind
+    if kind in 'iu':
+        return '<i8'
+    if kind == 'f':
+        return '<f8'
+    if kind == 'b':
+        return '|b1'
+    return 'text'
+
+def _flush(staging, buffers):
+    """Appends the buffered rows of every tile to its staging file and empties
+    the buffers
+    """
+    for t, frames in buffers.items():
+        with open(os.path.join(staging, '{}.pkl'.format(t)), 'ab') as f:
+            pickle.dump(pd.concat(frames), f, protocol = pickle.HIGHEST_PROTOCOL)
+    buffers.clear()
+
+def _read_staged(filename):
+    """Returns the rows appended to a staging file by _flush"""
+    frames = []
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                frames.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(frames, ignore_index = True)
+
+def _tile_arrays(tb, columns, dtypes, string_width):
+    """Returns the arrays stored in a tile: the catalog columns, a null mask
+    for every column with missing values in this tile, and the spatial columns
+    """
+    arrays = OrderedDict()
+    for c in columns:
+        values = tb[c]
+        nulls = values.isnull().values
+        if dtypes[c] == 'text':
+            values = np.asarray(values.where(~nulls, '').astype(str), dtype = str)
+            width = max(values.dtype.itemsize // 4, 1)
+            if string_width is not None and width > string_width:
+                raise ValueError('Column {} has a value of {} characters, longer than '
+                                 'string_width = {}'.format(c, width, string_width))
+            arrays[c] = values.astype('<U{}'.format(width))
+        else:
+            fill = False if dtypes[c] == '|b1' else 0
+            arrays[c] = values.where(~nulls, fill).values.astype(dtypes[c]) \
+                        if nulls.any() else values.values.astype(dtypes[c])
+        if nulls.any():
+            arrays[NULL_PREFIX + c] = nulls
+
+    arrays['_cell'] = tb['_cell'].values.astype('<i8')
+    for c in ['_x', '_y', '_z']:
+        arrays[c] = tb[c].values.astype('<f8')
+    return arrays
+
+def _column_values(parts, name):
+    """Concatenates a column over the tiles of a cone search, restoring the
+    missing values recorded in the null masks
+    """
+    values = np.concatenate([a[name][i] for a, i, _ in parts])
+    mask = NULL_PREFIX + name
+    if not any(mask in a for a, _, _ in parts):
+        return values
+
+    nulls = np.concatenate([a[mask][i] if mask in a else np.zeros(i.shape, dtype = bool)
+                            for a, i, _ in parts])
+    values = values.astype(object if values.dtype.kind == 'U' else np.float64)
+    values[nulls] = None if values.dtype == object else np.nan
+    return values
+
+def _column_dtype(catalog, name):
+    """Returns the dtype of a catalog column from any tile of the manifest"""
+    for info in catalog.tiles.values():
+        for c, dtype, _ in info['columns']:
+            if c == name:
+                return np.dtype(dtype)
+    return np.dtype(object)
+
+def _write_tile(filename, columns, order):
+    """Writes the columns of a tile back to back in cell order, each starting on
+    an 8 byte boundary
+
+    Returns:
+        info: (dict)
+            Rows of the tile and the name, dtype and offset of each column
+    """
+    info = {'rows': int(order.shape[0]), 'columns': []}
+    offset = 0
+    with open(filename, 'wb') as f:
+        for name, values in columns.items():
+            pad = -offset % 8
+            f.write(b'\0' * pad)
+            offset += pad
+            data = values[order].tobytes()
+            info['columns'].append([name, values.dtype.str, offset])
+            f.write(data)
+            offset += len(data)
+    return info
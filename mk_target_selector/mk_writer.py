@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import time
+import fcntl
+import queue
+import threading
+import numpy as np
+from dateutil import parser
+
+try:
+    from .logger import log as logger
+    from .mk_db import observation_rows
+
+except ImportError:
+    from logger import log as logger
+    from mk_db import observation_rows
+
+# DBAPI exceptions, by their PEP 249 names, that retrying cannot fix
+PERMANENT_ERRORS = ('ProgrammingError', 'IntegrityError', 'DataError',
+                    'NotSupportedError')
+
+# Schema errors that some drivers raise as OperationalError
+SCHEMA_ERRORS = re.compile(r'no such (column|table)|has no column named|unknown column',
+                           re.IGNORECASE)
+
+class Write_Behind(object):
+    """
+    Write-behind queue for the observation bookkeeping. Observation records
+    and status updates are queued and return immediately; a background thread
+    groups them into batched, parameterized statements and retries failures
+    with exponential backoff. Records that cannot be queued because the queue
+    is full, or that still fail after every retry, are appended to a local
+    JSON lines journal, which is replayed when the writer next starts. Records
+    the database rejects outright, such as schema or constraint errors, are
+    not retried but moved to a dead-letter file.
+
+    Examples:
+        >>> writer = Write_Behind(triage, journal = 'write_behind.journal')
+        >>> writer.add_sources(targets, start, end, proxies, antennas, file_id, bands)
+        >>> writer.update_status(source_id, obs_start_time, success)
+    """
+    def __init__(self, triage, maxsize = 10000, batch_size = 1000, flush_interval = 1.0,
+                 max_retries = 5, backoff = 0.5, max_backoff = 30.0,
+                 journal = 'write_behind.journal', dead_letter = None):
+        """
+        __init__ function for the Write_Behind class
+
+        Parameters:
+            triage: (mk_db.Triage)
+                Database handler the records are written through
+            maxsize: (int)
+                Maximum number of queued records
+            batch_size: (int)
+                Maximum number of records written per batch
+            flush_interval: (float)
+                Seconds the worker waits for more records before writing
+            max_retries: (int)
+                Number of retries before a batch is journaled
+            backoff, max_backoff: (float)
+                First and largest delay between retries in seconds
+            journal: (str)
+                Path of the append-only journal. Each writer needs its own.
+            dead_letter: (str)
+                Path that permanently failing records are appended to.
+                Defaults to the journal path with a .dead suffix
+
+        Returns:
+            None
+        """
+        self.triage = triage
+        self.queue = queue.Queue(maxsize = maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.journal = journal
+        self.dead_letter = dead_letter or journal + '.dead'
+
+        self.written = 0
+        self.retries = 0
+        self.journaled = 0
+        self.dead = 0
+        self._journal_lock = threading.Lock()
+
+        self.worker = threading.Thread(target = self._work, name = 'write-behind')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def add_sources(self, df, start_time, end_time, proxies, antennas, file_id,
+                    bands, mode = 0, table = 'observation_status'):
+        """Queues the sources of an observed field. Takes the same arguments as
+        Triage.add_sources_to_db. The sources are marked as observed straight
+        away.
+
+        Returns:
+            None
+        """
+        source_ids = np.asarray(df['source_id'].values, dtype = np.int64)
+        if source_ids.shape[0] == 0:
+            return
+
+        self._put({'kind': 'sources', 'table': table,
+                   'source_ids': source_ids.tolist(),
+                   'start_time': start_time, 'end_time': end_time,
+                   'proxies': proxies, 'antennas': antennas, 'file_id': file_id,
+                   'bands': bands, 'mode': mode})
+
+        if table == self.triage.observed.table:
+            self.triage.observed.add(source_ids)
+
+    def update_status(self, source_id, obs_start_time, success,
+                      table = 'observation_status'):
+        """Queues a status update. Takes the same arguments as
+        Triage.update_obs_status.
+
+        Returns:
+            None
+        """
+        self._put({'kind': 'status', 'table': table, 'source_id': int(source_id),
+                   'obs_start_time': obs_start_time, 'success': bool(success)})
+
+        if table == self.triage.observed.table:
+            self.triage.observed.add(source_id)
+
+    def _put(self, record):
+        """Queues a record, or journals it if the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            logger.warning('Write-behind queue full. Journaling {} record'.format(
+                           record['kind']))
+            self._journal([record])
+
+    def _work(self):
+        """Worker loop. Replays the journal, then writes queued records in
+        batches until a None sentinel is received
+        """
+        try:
+            self._replay()
+        except Exception as e:
+            logger.error('Failed to replay {}: {}'.format(self.journal, e))
+
+        running = True
+        while running:
+            try:
+                record = self.queue.get(timeout = self.flush_interval)
+            except queue.Empty:
+                continue
+
+            batch = []
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            running = record is not None
+
+            try:
+                if batch:
+                    self._write(batch)
+            except Exception as e:
+                logger.error('Write-behind batch of {} record(s) failed: {}'.format(
+                             len(batch), e))
+                try:
+                    self._journal(batch)
+                except Exception as e:
+                    logger.error('Could not journal {} record(s): {}'.format(
+                                 len(batch), e))
+            finally:
+                for _ in range(len(batch) + (not running)):
+                    self.queue.task_done()
+
+    def _write(self, batch):
+        """Writes a batch, one statement per run of records of the same kind and
+        table so that updates are applied after the inserts queued before them
+        """
+        start = 0
+        for i in range(1, len(batch) + 1):
+            if i < len(batch) and (batch[i]['kind'], batch[i]['table']) == \
+                    (batch[start]['kind'], batch[start]['table']):
+                continue
+
+            records = batch[start:i]
+            error = self._retry(records)
+            if error is None:
+                self.written += len(records)
+            elif _permanent(error):
+                self._dead_letter(records, error)
+            else:
+                self._journal(records)
+            start = i
+
+    def _retry(self, records):
+        """Writes a run of records, retrying transient failures with exponential
+        backoff
+
+        Returns:
+            error: (Exception)
+                None if the records were written, otherwise the last error
+        """
+        kind, table = records[0]['kind'], records[0]['table']
+        if kind == 'sources':
+            rows = [row for r in records for row in observation_rows(
+                    r['source_ids'], r['start_time'], r['end_time'], r['proxies'],
+                    r['antennas'], r['file_id'], r['bands'], r['mode'])]
+            write = self.triage.insert_observations
+        else:
+            rows = [(r['success'], r['source_id'], r['obs_start_time']) for r in records]
+            write = self.triage.update_statuses
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                write(rows, table)
+                return None
+            except Exception as e:
+                if _permanent(e):
+                    logger.error('Writing {} {} record(s) to {} failed permanently: '
+                                 '{}'.format(len(records), kind, table, e))
+                    return e
+                if attempt == self.max_retries:
+                    logger.error('Failed to write {} {} record(s) to {} after {} '
+                                 'retries: {}'.format(len(records), kind, table,
+                                                      attempt, e))
+                    return e
+                delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+                logger.warning('Writing {} record(s) to {} failed: {}. Retrying in '
+                               '{} s'.format(kind, table, e, delay))
+                self.retries += 1
+                time.sleep(delay)
+
+    def _journal(self, records):
+        """Appends records to the journal"""
+        self._append(self.journal, records)
+        self.journaled += len(records)
+
+    def _dead_letter(self, records, error):
+        """Appends records the database rejected to the dead-letter file"""
+        logger.error('Moving {} record(s) to {}'.format(len(records), self.dead_letter))
+        self._append(self.dead_letter, records, error = str(error))
+        self.dead += len(records)
+
+    def _append(self, path, records, error = None):
+        """Appends records to a JSON lines file and syncs it to disk"""
+        lines = []
+        for r in records:
+            r = dict(r)
+            for k in ['start_time', 'end_time', 'obs_start_time']:
+                if hasattr(r.get(k), 'isoformat'):
+                    r[k] = r[k].isoformat()
+            if error is not None:
+                r['error'] = error
+            lines.append(json.dumps(r) + '\n')
+
+        with self._journal_lock:
+            with open(path, 'a') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _replay(self):
+        """Writes the records left in the journal by a previous run. The journal
+        is moved aside first so records that fail again are journaled afresh;
+        the moved file is only removed once every record has been handled. An
+        exclusive lock on a .lock file keeps any other writer, in this process
+        or another, from replaying the same records.
+        """
+        with open(self.journal + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                logger.warning('{} is being replayed by another writer'.format(
+                               self.journal))
+                return
+            try:
+                self._replay_locked()
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _replay_locked(self):
+        """Replays the journal. Must be called holding the replay lock"""
+        replay = self.journal + '.replay'
+        with self._journal_lock:
+            if os.path.exists(self.journal) and not os.path.exists(replay):
+                os.rename(self.journal, replay)
+        if not os.path.exists(replay):
+            return
+
+        records = []
+        with open(replay, 'r') as f:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    logger.warning('Skipping unreadable journal line: {}'.format(line))
+                    continue
+                for k in ['start_time', 'end_time']:
+                    if r.get(k):
+                        r[k] = parser.parse(r[k])
+                records.append(r)
+
+        logger.info('Replaying {} journaled record(s)'.format(len(records)))
+        for i in range(0, len(records), self.batch_size):
+            self._write(records[i:i + self.batch_size])
+        os.remove(replay)
+
+    def flush(self):
+        """Blocks until every queued record has been written or journaled"""
+        self.queue.join()
+
+    def stop(self, timeout = 30.0):
+        """Writes the queued records and stops the worker. Records still queued
+        after timeout seconds are journaled, so they are written on the next
+        start.
+
+        Parameters:
+            timeout: (float)
+                Seconds to wait for the worker. None waits indefinitely.
+
+        Returns:
+            None
+        """
+        self.queue.put(None)
+        self.worker.join(timeout)
+        if not self.worker.is_alive():
+            return
+
+        records = []
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is not None:
+                records.append(record)
+            self.queue.task_done()
+        if records:
+            logger.warning('Write-behind did not finish in {} s. Journaling {} '
+                           'queued record(s)'.format(timeout, len(records)))
+            self._journal(records)
+
+    def stats(self):
+        """Returns the queue depth and write counters
+
+        Returns:
+            stats: (dict)
+        """
+        return {'depth': self.queue.qsize(), 'written': self.written,
+                'retries': self.retries, 'journaled': self.journaled,
+                'dead': self.dead}
+
+def _permanent(error):
+    """Returns True if a database error will not go away by retrying"""
+    error = getattr(error, 'orig', None) or error
+    return type(error).__name__ in PERMANENT_ERRORS or \
+           SCHEMA_ERRORS.search(str(error)) is not None
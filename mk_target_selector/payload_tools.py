@@ -0,0 +1,247 @@
+import json
+import struct
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# First bytes of a binary target list and of a binary target delta
+MAGIC = b'MKT1'
+DELTA_MAGIC = b'MKD1'
+
+# Key suffix announcing the encoding of a published target list
+SUFFIXES = {'json': '', 'binary': '.bin', 'msgpack': '.msgpack'}
+
+def encode_targets(targets, columns = ['ra', 'decl', 'priority'], fmt = 'json',
+                   float_dtype = '<f8'):
+    """Serialises a target table for publication
+
+    The binary format is MAGIC, a little-endian uint32 header length, a JSON
+    header {"n": rows, "columns": [[name, dtype], ...]} and then the raw
+    little-endian column arrays back to back in header order. msgpack packs
+    the same header fields plus a list of the raw column buffers. Both are
+    built directly from the column arrays. source_id is always included (as
+    int64) in the binary formats when the table has it.
+
+    Parameters:
+        targets: (pandas.DataFrame)
+            Target information
+        columns: (list)
+            Columns to serialise
+        fmt: (str)
+            'json', 'binary' or 'msgpack'
+        float_dtype: (str)
+            '<f8' or '<f4'. Dtype of floating point columns in the binary formats
+
+    Returns:
+        payload: (str, bytes)
+    """
+    if fmt == 'json':
+        return json.dumps(targets.loc[:, columns].to_dict('list'))
+
+    if fmt not in SUFFIXES:
+        raise ValueError('Unknown target list format: {}'.format(fmt))
+
+    if 'source_id' in targets and 'source_id' not in columns:
+        columns = ['source_id'] + list(columns)
+
+    header = {'n': int(targets.shape[0])}
+    header['columns'], buffers = _pack_columns(targets, columns, float_dtype)
+
+    if fmt == 'msgpack':
+        header['data'] = buffers
+        return _packb(header)
+
+    return _frame(MAGIC, header, buffers)
+
+def encode_delta(seq, base, targets, removed, columns = ['source_id', 'ra', 'decl', 'priority'],
+                 fmt = 'json', float_dtype = '<f8'):
+    """Serialises the change between two published target lists
+
+    Parameters:
+        seq: (int)
+            Sequence number of this update
+        base: (int, None)
+            Sequence number the delta applies to. None marks a full snapshot
+            that replaces whatever the reader holds.
+        targets: (pandas.DataFrame)
+            Added sources and sources whose values changed
+        removed: (np.ndarray)
+            source_id of the sources no longer in the list
+        columns: (list)
+            Columns of targets to serialise. Should include source_id.
+        fmt: (str)
+            'json', 'binary' or 'msgpack'
+        float_dtype: (str)
+            '<f8' or '<f4'. Dtype of floating point columns in the binary formats
+
+    Returns:
+        payload: (str, bytes)
+    """
+    removed = np.ascontiguousarray(removed, dtype = '<i8')
+
+    if fmt == 'json':
+        return json.dumps({'seq': seq, 'base': base,
+                           'targets': targets.loc[:, columns].to_dict('list'),
+                           'removed': removed.tolist()})
+
+    if fmt not in SUFFIXES:
+        raise ValueError('Unknown target list format: {}'.format(fmt))
+
+    header = {'seq': seq, 'base': base, 'n': int(targets.shape[0]),
+              'n_removed': int(removed.shape[0])}
+    header['columns'], buffers = _pack_columns(targets, columns, float_dtype)
+
+    if fmt == 'msgpack':
+        header['data'] = buffers
+        header['removed'] = removed.tobytes()
+        return _packb(header)
+
+    return _frame(DELTA_MAGIC, header, buffers + [removed.tobytes()])
+
+def diff_targets(old_ids, old_priority, targets):
+    """Compares a target list with the previously published one
+
+    Parameters:
+        old_ids: (np.ndarray)
+            Sorted source_id of the previous list
+        old_priority: (np.ndarray)
+            Priorities of the previous list, aligned with old_ids
+        targets: (pandas.DataFrame)
+            New target list with source_id and priority columns
+
+    Returns:
+        changed: (pandas.DataFrame)
+            Rows of targets that are new or whose priority changed
+        removed: (np.ndarray)
+            source_id of previous sources missing from targets
+        ids, priority: (np.ndarray)
+            Sorted source_id and aligned priorities of targets, to be passed
+            as old_ids and old_priority next time
+    """
+    order = np.argsort(targets['source_id'].values, kind = 'mergesort')
+    ids = targets['source_id'].values.astype(np.int64)[order]
+    priority = targets['priority'].values.astype(np.float64)[order]
+
+    removed = np.setdiff1d(old_ids, ids, assume_unique = True)
+    if old_ids.shape[0]:
+        pos = np.minimum(np.searchsorted(old_ids, ids), old_ids.shape[0] - 1)
+        same = (old_ids[pos] == ids) & (old_priority[pos] == priority)
+    else:
+        same = np.zeros(ids.shape, dtype = bool)
+
+    return targets.iloc[order[~same]], removed, ids, priority
+
+def decode_targets(payload):
+    """Reference decoder for payloads written by encode_targets. The format is
+    detected from the payload itself.
+
+    Parameters:
+        payload: (str, bytes)
+            Value read from redis. Binary payloads must be read with a client
+            that does not decode responses.
+
+    Returns:
+        targets: (dict)
+            Column name to np.ndarray (binary formats) or list (json)
+    """
+    if isinstance(payload, bytes) and payload[:len(MAGIC)] == MAGIC:
+        return _read_columns(payload, *_unframe(payload))[0]
+
+    if isinstance(payload, bytes):
+        if _is_msgpack(payload):
+            header = _unpackb(payload)
+            return {name: np.frombuffer(data, dtype = dtype, count = header['n'])
+                    for (name, dtype), data in zip(header['columns'], header['data'])}
+        payload = payload.decode()
+
+    return json.loads(payload)
+
+def decode_delta(payload):
+    """Reference decoder for payloads written by encode_delta
+
+    Parameters:
+        payload: (str, bytes)
+            Value read from redis
+
+    Returns:
+        delta: (dict)
+            seq, base (None for a full snapshot), targets (column name to
+            values of the added or changed sources) and removed (source_id)
+    """
+    if isinstance(payload, bytes) and payload[:len(DELTA_MAGIC)] == DELTA_MAGIC:
+        header, offset = _unframe(payload)
+        targets, offset = _read_columns(payload, header, offset)
+        removed = np.frombuffer(payload, dtype = '<i8', count = header['n_removed'],
+                                offset = offset)
+
+    elif isinstance(payload, bytes) and _is_msgpack(payload):
+        header = _unpackb(payload)
+        targets = {name: np.frombuffer(data, dtype = dtype, count = header['n'])
+                   for (name, dtype), data in zip(header['columns'], header['data'])}
+        removed = np.frombuffer(header['removed'], dtype = '<i8')
+
+    else:
+        if isinstance(payload, bytes):
+            payload = payload.decode()
+        header = json.loads(payload)
+        targets, removed = header['targets'], np.asarray(header['removed'], dtype = np.int64)
+
+    return {'seq': header['seq'], 'base': header['base'], 'targets': targets,
+            'removed': removed}
+
+def _pack_columns(targets, columns, float_dtype):
+    """Returns the [name, dtype] header entries and raw little-endian buffers
+    of a set of columns
+    """
+    header, buffers = [], []
+    for c in columns:
+        values = targets[c].values
+        dtype = '<i8' if values.dtype.kind in 'iub' else float_dtype
+        buffers.append(np.ascontiguousarray(values, dtype = dtype).tobytes())
+        header.append([c, dtype])
+    return header, buffers
+
+def _packb(header):
+    """Packs a header holding raw buffers with msgpack"""
+    if msgpack is None:
+        raise ImportError('The msgpack target list format requires msgpack')
+    return msgpack.packb(header, use_bin_type = True)
+
+def _unpackb(payload):
+    """Unpacks a msgpack payload"""
+    if msgpack is None:
+        raise ImportError('Decoding msgpack target lists requires msgpack')
+    return msgpack.unpackb(payload, raw = False)
+
+def _frame(magic, header, buffers):
+    """Joins the magic bytes, the length prefixed JSON header and the buffers"""
+    header = json.dumps(header).encode()
+    return b''.join([magic, struct.pack('<I', len(header)), header] + buffers)
+
+def _unframe(payload):
+    """Returns the JSON header and the offset of the first buffer of a binary
+    payload"""
+    start = len(MAGIC) + 4
+    n_header = struct.unpack('<I', payload[len(MAGIC):start])[0]
+    header = json.loads(payload[start:start + n_header].decode())
+    return header, start + n_header
+
+def _read_columns(payload, header, offset):
+    """Reads the column arrays that follow a binary header"""
+    targets = {}
+    for name, dtype in header['columns']:
+        dtype = np.dtype(dtype)
+        targets[name] = np.frombuffer(payload, dtype = dtype, count = header['n'],
+                                      offset = offset)
+        offset += header['n'] * dtype.itemsize
+    return targets, offset
+
+def _is_msgpack(payload):
+    """Returns True if a bytes payload is not JSON text"""
+    try:
+        return not payload.decode().lstrip().startswith('{')
+    except UnicodeDecodeError:
+        return True
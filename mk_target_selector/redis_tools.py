@@ -102,3 +102,64 @@ def publish(server, channel, message):
     except:
         log.error('Failed to publish to {} --> {}'.format(channel, message))
         return False
+
+def write_and_publish(server, pairs, channel, expiration=None, transaction=True,
+                      registry=None):
+    """Writes several key-value pairs and announces each key on a channel in a
+    single round trip to the redis server
+
+    Parameters:
+        server: (redis.StrictRedis)
+            a redis-py redis server object
+        pairs: (list)
+            (key, value) pairs to write, in publication order
+        channel: (str)
+            Channel to publish the keys on
+        expiration (number):
+            number of seconds before key expiration
+        transaction (bool):
+            Wrap the batch in MULTI/EXEC so subscribers never receive a key
+            before it has been set
+        registry (str):
+            Name of a set the written keys are added to, see unlink_registry
+
+    Returns:
+        True if success, False otherwise, and logs an 'error' message on failure
+    """
+    try:
+        pipe = server.pipeline(transaction=transaction)
+        for key, value in pairs:
+            pipe.set(key, value, ex=expiration)
+        if registry is not None and pairs:
+            pipe.sadd(registry, *[key for key, _ in pairs])
+        for key, _ in pairs:
+            pipe.publish(channel, key)
+        pipe.execute()
+        return True
+    except:
+        log.error('Failed to write and publish {} keys to {}'.format(len(pairs), channel))
+        return False
+
+def unlink_registry(server, registry):
+    """Removes every key recorded in a registry set, and the set itself, with
+    a single UNLINK so the memory is reclaimed in the background
+
+    Parameters:
+        server: (redis.StrictRedis)
+            a redis-py redis server object
+        registry (str):
+            Name of the set written by write_and_publish
+
+    Returns:
+        n: (int)
+            Number of keys removed, or None on failure
+    """
+    try:
+        keys = list(server.smembers(registry))
+        pipe = server.pipeline(transaction=False)
+        pipe.execute_command('UNLINK', registry, *keys)
+        removed = pipe.execute()[0]
+        return max(removed - 1, 0)
+    except:
+        log.error("Failed to remove keys registered in: {}".format(registry))
+        return None
@@ -0,0 +1,277 @@
+import numpy as np
+
+# Order of the HEALPix (NESTED) cells stored alongside each source. Every
+# coarser cell maps onto a contiguous range of cell ids at this order.
+CELL_ORDER = 14
+
+_JRLL = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4], dtype=np.int64)
+_JPLL = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7], dtype=np.int64)
+
+def radec_to_vec(ra, dec):
+    """Converts equatorial coordinates to cartesian unit vectors
+
+    Parameters:
+        ra, dec: (float, np.ndarray)
+            Right ascension and declination in radians
+
+    Returns:
+        x, y, z: (np.ndarray)
+            Cartesian components of the unit vectors
+    """
+    ra = np.asarray(ra, dtype=np.float64)
+    dec = np.asarray(dec, dtype=np.float64)
+    cos_dec = np.cos(dec)
+    return cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)
+
+def spatial_columns(ra, dec, cell_order = CELL_ORDER):
+    """Returns the derived spatial columns stored with each catalog source
+
+    Parameters:
+        ra, dec: (np.ndarray)
+            Right ascension and declination in degrees
+        cell_order: (int)
+            HEALPix order of the stored cell ids
+
+    Returns:
+        columns: (dict)
+            Unit vector components (cx, cy, cz) and NESTED HEALPix cell id
+    """
+    ra = np.deg2rad(np.asarray(ra, dtype=np.float64))
+    dec = np.deg2rad(np.asarray(dec, dtype=np.float64))
+    cx, cy, cz = radec_to_vec(ra, dec)
+    return {'cx': cx, 'cy': cy, 'cz': cz, 'cell': ang2pix(cell_order, ra, dec)}
+
+def chord_radius(beam_rad):
+    """Returns the squared chord length subtended by an angle on the unit sphere
+
+    Parameters:
+        beam_rad: (float)
+            Angular radius in radians
+
+    Returns:
+        chord2: (float)
+            Squared straight line distance between two unit vectors separated
+            by beam_rad
+    """
+    return (2.0 * np.sin(0.5 * min(beam_rad, np.pi))) ** 2
+
+def chord_to_angle(chord2):
+    """Converts squared chord lengths back into angular separations (radians)
+    """
+    return 2.0 * np.arcsin(np.clip(0.5 * np.sqrt(chord2), 0.0, 1.0))
+
+def separation(ra, dec, c_ra, c_dec):
+    """Returns the angular separation between sources and a pointing
+
+    Parameters:
+        ra, dec: (np.ndarray)
+            Source coordinates in degrees
+        c_ra, c_dec: (float, np.ndarray)
+            Pointing coordinates in radians
+
+    Returns:
+        sep: (np.ndarray)
+            Angular separation in radians
+    """
+    x, y, z = radec_to_vec(np.deg2rad(ra), np.deg2rad(dec))
+    x0, y0, z0 = radec_to_vec(c_ra, c_dec)
+    return chord_to_angle((x - x0) ** 2 + (y - y0) ** 2 + (z - z0) ** 2)
+
+def _spread_bits(v):
+    """Interleaves the bits of v with zeros (bit i moves to bit 2i)"""
+    v = v.astype(np.int64)
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    return (v | (v << 1)) & 0x5555555555555555
+
+def _compress_bits(v):
+    """Inverse of _spread_bits"""
+    v = v.astype(np.int64) & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    return (v | (v >> 16)) & 0x00000000FFFFFFFF
+
+def ang2pix(order, ra, dec):
+    """Returns the NESTED HEALPix cell id of a set of sky positions
+
+    Parameters:
+        order: (int)
+            HEALPix order, nside = 2**order
+        ra, dec: (float, np.ndarray)
+            Coordinates in radians
+
+    Returns:
+        pix: (np.ndarray)
+            int64 cell ids
+    """
+    nside = 1 << order
+    z = np.sin(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+    tt = np.mod(np.atleast_1d(np.asarray(ra, dtype=np.float64)),
+                2.0 * np.pi) * (2.0 / np.pi)
+    tt = np.where(tt >= 4.0, 0.0, tt)
+    z, tt = np.broadcast_arrays(z, tt)
+    za = np.abs(z)
+
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    # Equatorial region
+    eq = za <= 2.0 / 3.0
+    t1 = nside * (0.5 + tt[eq])
+    t2 = nside * z[eq] * 0.75
+    jp = (t1 - t2).astype(np.int64)
+    jm = (t1 + t2).astype(np.int64)
+    ifp = jp >> order
+    ifm = jm >> order
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    pol = ~eq
+    ntt = np.minimum(tt[pol].astype(np.int64), 3)
+    tp = tt[pol] - ntt
+    tmp = nside * np.sqrt(3.0 * (1.0 - za[pol]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[pol] > 0
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+
+    return (face << (2 * order)) + _spread_bits(ix) + (_spread_bits(iy) << 1)
+
+def pix2vec(order, pix):
+    """Returns the unit vectors of the centres of NESTED HEALPix cells
+
+    Parameters:
+        order: (int)
+            HEALPix order, nside = 2**order
+        pix: (np.ndarray)
+            Cell ids
+
+    Returns:
+        x, y, z: (np.ndarray)
+            Cartesian components of the cell centres
+    """
+    nside = 1 << order
+    npix = 12 * nside * nside
+    pix = np.atleast_1d(np.asarray(pix, dtype=np.int64))
+    face = pix >> (2 * order)
+    sub = pix & ((1 << (2 * order)) - 1)
+    ix = _compress_bits(sub)
+    iy = _compress_bits(sub >> 1)
+
+    jr = _JRLL[face] * nside - ix - iy - 1
+    north = jr < nside
+    south = jr > 3 * nside
+    nr = np.where(north, jr, np.where(south, 4 * nside - jr, nside))
+    z = np.where(north, 1.0 - nr * nr * (4.0 / npix),
+                 np.where(south, nr * nr * (4.0 / npix) - 1.0,
+                          (2 * nside - jr) * (2.0 / (3.0 * nside))))
+    kshift = np.where(north | south, 0, (jr - nside) & 1)
+    jp = (_JPLL[face] * nr + ix - iy + 1 + kshift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, jp)
+    jp = np.where(jp < 1, jp + 4 * nside, jp)
+    phi = (jp - (kshift + 1) * 0.5) * (0.5 * np.pi / nr)
+
+    sin_theta = np.sqrt(np.maximum(0.0, 1.0 - z * z))
+    return sin_theta * np.cos(phi), sin_theta * np.sin(phi), z
+
+def max_pixrad(order):
+    """Returns the maximum angular distance (radians) between the centre of a
+    HEALPix cell and any of its corners at a given order
+    """
+    nside = 1 << order
+    z_a, phi_a = 2.0 / 3.0, np.pi / (4.0 * nside)
+    t1 = (1.0 - 1.0 / nside) ** 2
+    z_b, phi_b = 1.0 - t1 / 3.0, 0.0
+    s_a, s_b = np.sqrt(1.0 - z_a ** 2), np.sqrt(1.0 - z_b ** 2)
+    cos_ang = s_a * s_b * np.cos(phi_a - phi_b) + z_a * z_b
+    return float(np.arccos(np.clip(cos_ang, -1.0, 1.0)))
+
+_MAX_PIXRAD = [max_pixrad(o) for o in range(30)]
+
+def order_for_radius(beam_rad, max_order = CELL_ORDER):
+    """Chooses the HEALPix order used to cover a beam. Cells at the chosen order
+    are roughly the size of the beam, so a disc touches only a handful of them.
+
+    Parameters:
+        beam_rad: (float)
+            Angular radius of the beam in radians
+        max_order: (int)
+            Finest order that can be returned
+
+    Returns:
+        order: (int)
+    """
+    order = 0
+    while order < max_order and _MAX_PIXRAD[order + 1] >= beam_rad:
+        order += 1
+    return order
+
+def query_disc(c_ra, c_dec, beam_rad, order):
+    """Returns every NESTED cell at a given order that may overlap a disc. The
+    search walks down from a coarse order and only refines cells that can touch the
+    disc, so the pole and the RA wraparound need no special handling.
+
+    Parameters:
+        c_ra, c_dec: (float)
+            Disc centre in radians
+        beam_rad: (float)
+            Disc radius in radians
+        order: (int)
+            Order of the returned cells
+
+    Returns:
+        pix: (np.ndarray)
+            Sorted int64 cell ids
+    """
+    x0, y0, z0 = radec_to_vec(c_ra, c_dec)
+    start = min(order, 3)
+    pix = np.arange(12 << (2 * start), dtype=np.int64)
+    for o in range(start, order + 1):
+        if o > start:
+            pix = ((pix << 2)[:, np.newaxis] + np.arange(4)).ravel()
+        limit = beam_rad + _MAX_PIXRAD[o] * 1.01
+        if limit < np.pi:
+            x, y, z = pix2vec(o, pix)
+            pix = pix[x * x0 + y * y0 + z * z0 >= np.cos(limit)]
+    return pix
+
+def cell_ranges(pix, order, cell_order = CELL_ORDER):
+    """Converts cells at some order into half-open ranges of cell ids at
+    cell_order, merging neighbouring cells into a single range
+
+    Parameters:
+        pix: (np.ndarray)
+            Sorted NESTED cell ids at order
+        order: (int)
+            Order of pix
+        cell_order: (int)
+            Order of the cell ids stored with each source
+
+    Returns:
+        ranges: (np.ndarray)
+            Array of shape (N, 2) with [start, stop) cell ids
+    """
+    pix = np.asarray(pix, dtype=np.int64)
+    if pix.size == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    shift = 2 * (cell_order - order)
+    breaks = np.flatnonzero(np.diff(pix) != 1) + 1
+    starts = pix[np.concatenate(([0], breaks))]
+    stops = pix[np.concatenate((breaks - 1, [pix.size - 1]))] + 1
+    return np.column_stack((starts << shift, stops << shift))
+
+def disc_ranges(c_ra, c_dec, beam_rad, cell_order = CELL_ORDER):
+    """Returns the ranges of cell ids at cell_order that cover a disc, searched
+    at an order chosen for the size of the disc
+    """
+    order = order_for_radius(beam_rad, cell_order)
+    return cell_ranges(query_disc(c_ra, c_dec, beam_rad, order), order, cell_order)
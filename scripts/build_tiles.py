@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+'''
+
+Partitions a catalog into the HEALPix tile layout read by
+mk_target_selector.mk_tiles.Tile_Catalog (see the index.tiles setting in
+config.yml). The catalog is streamed from a CSV file or from the catalog table
+in chunks, so it does not need to fit in memory.
+
+'''
+
+import sys
+import pandas as pd
+from argparse import (
+    ArgumentParser,
+    ArgumentDefaultsHelpFormatter
+)
+from mk_target_selector.mk_tiles import Tile_Catalog
+
+def cli(prog=sys.argv[0]):
+    usage = "{} [options]".format(prog)
+    description = 'MeerKAT Breakthrough Listen Tile Catalog Builder'
+
+    parser = ArgumentParser(usage=usage,
+                            description=description,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-i', '--input',
+        type=str,
+        default=None,
+        help='Catalog CSV file. Reads the catalog table of the database in the config file if not given')
+    parser.add_argument(
+        '-c', '--config',
+        type=str,
+        default="config.yml",
+        help='Target selector configuration file')
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        required=True,
+        help='Tile catalog directory')
+    parser.add_argument(
+        '-t', '--table',
+        type=str,
+        default="target_list",
+        help='Name of the catalog table')
+    parser.add_argument(
+        '--tile-order',
+        type=int,
+        default=5,
+        help='HEALPix order of the tiles')
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=1000000,
+        help='Number of catalog rows partitioned at a time')
+    parser.add_argument(
+        '--string-width',
+        type=int,
+        default=None,
+        help='Maximum length of text values. Unlimited if not given')
+
+    args = parser.parse_args()
+    main(input_file = args.input,
+         config_file = args.config,
+         output = args.output,
+         table = args.table,
+         tile_order = args.tile_order,
+         chunksize = args.chunksize,
+         string_width = args.string_width)
+
+def main(input_file, config_file, output, table, tile_order, chunksize,
+         string_width = None):
+    if input_file is not None:
+        chunks = pd.read_csv(input_file, chunksize = chunksize)
+    else:
+        from mk_target_selector.mk_db import Database_Handler
+        db = Database_Handler(config_file)
+        chunks = pd.read_sql('SELECT * FROM {}'.format(table), con = db.engine,
+                             chunksize = chunksize)
+
+    catalog = Tile_Catalog.build(output, chunks, tile_order = tile_order,
+                                 string_width = string_width)
+    print ('Wrote {} sources in {} tiles to {}'.format(len(catalog),
+                                                      len(catalog.tiles), output))
+
+if __name__ == '__main__':
+    cli()
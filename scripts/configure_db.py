@@ -2,14 +2,20 @@
 
 '''
 
-This script is pretty slow for creating the database. Will work on adding support
-for bulk inserting data from csv file in the future.
+Creates the target selector database. The catalog is streamed from a local CSV
+file or URL in fixed-size chunks; each chunk gets its spatial columns and is
+bulk inserted by a pool of worker processes, and the indexes are built once
+the load is complete.
 
 '''
 
 import os
+import time
 import yaml
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from mk_target_selector.sky_tools import spatial_columns
 from getpass import getpass
 from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
@@ -40,6 +46,7 @@ class Observation(Base):
     file_id = Column(VARCHAR(45))
     mode = Column(INT)
     time = Column(TIMESTAMP)
+    success = Column(BOOLEAN, default = False)
 
 
 def cli(prog=sys.argv[0]):
@@ -64,17 +71,46 @@ def cli(prog=sys.argv[0]):
         type=str,
         default="localhost",
         help='Database host')
+    parser.add_argument(
+        '-s', '--sqlite',
+        type=str,
+        default=None,
+        help='Build a local SQLite database at this path instead of using MySQL')
+    parser.add_argument(
+        '-c', '--catalog',
+        type=str,
+        default=data_link,
+        help='Path or URL of the catalog CSV file')
+    parser.add_argument(
+        '--chunksize',
+        type=int,
+        default=100000,
+        help='Number of catalog rows read and inserted at a time')
+    parser.add_argument(
+        '-j', '--workers',
+        type=int,
+        default=4,
+        help='Number of insert processes (SQLite always uses one)')
 
     args = parser.parse_args()
+
+    if args.sqlite:
+        main_sqlite(args.sqlite, catalog = args.catalog,
+                    chunksize = args.chunksize)
+        return
+
     password = getpass('Password for {}@{}: '.format(args.username, args.host))
 
     main(user = args.username,
          password = password,
          host = args.host,
-         schema_name = args.database)
+         schema_name = args.database,
+         catalog = args.catalog,
+         chunksize = args.chunksize,
+         workers = args.workers)
 
-def write_yaml(cred, filename = 'config.yml'):
-    data = {"mysql": cred}
+def write_yaml(cred, filename = 'config.yml', backend = 'mysql'):
+    data = {backend: cred}
 
     if os.path.basename(os.getcwd()) == 'scripts':
         path = os.path.split(os.getcwd())[0]
@@ -83,7 +119,131 @@ def write_yaml(cred, filename = 'config.yml'):
     with open(filename, 'w') as outfile:
         yaml.dump(data, outfile, default_flow_style=False)
 
-def main(user, password, host, schema_name):
+def add_spatial_columns(tb):
+    for name, values in spatial_columns(tb['ra'], tb['decl']).items():
+        tb[name] = values
+    return tb
+
+def load_catalog(catalog = data_link):
+    return add_spatial_columns(pd.read_csv(catalog))
+
+# Engine of an insert worker process, created by _init_worker
+_worker_engine = None
+
+def _init_worker(url):
+    global _worker_engine
+    _worker_engine = create_engine(url)
+
+def _insert_chunk(table, chunk):
+    """Adds the spatial columns to a chunk of the catalog and inserts it with
+    one executemany. Runs in a worker process.
+    """
+    chunk = add_spatial_columns(chunk)
+    if chunk.isnull().values.any():
+        chunk = chunk.astype(object).where(chunk.notnull(), None)
+
+    quote = _worker_engine.dialect.identifier_preparer.quote
+    marker = '?' if _worker_engine.dialect.paramstyle == 'qmark' else '%s'
+    insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+             quote(table), ', '.join(quote(c) for c in chunk.columns),
+             ', '.join([marker] * chunk.shape[1]))
+
+    conn = _worker_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany(insert, list(chunk.itertuples(index = False, name = None)))
+        cursor.close()
+        conn.commit()
+    finally:
+        conn.close()
+    return chunk.shape[0]
+
+def stream_catalog(url, table, catalog = data_link, chunksize = 100000, workers = 4):
+    """Creates the catalog table and fills it from a CSV file in chunks. At most
+    two chunks per worker are held in memory at any time.
+
+    Parameters:
+        url: (str, sqlalchemy.engine.url.URL)
+            Database the worker processes connect to
+        table: (str)
+            Name of the catalog table
+        catalog: (str)
+            Path or URL of the catalog CSV file
+        chunksize: (int)
+            Number of rows per chunk
+        workers: (int)
+            Number of insert processes
+
+    Returns:
+        n: (int)
+            Number of rows loaded
+    """
+    reader = pd.read_csv(catalog, chunksize = chunksize)
+    first = next(reader)
+
+    # Create the empty table from the first chunk so the workers only insert
+    engine = create_engine(url)
+    add_spatial_columns(first.head(0).copy()).to_sql(
+        table, engine, index = False, if_exists = 'replace',
+        dtype = {'cell': BIGINT()})
+    engine.dispose()
+
+    start = time.time()
+    n = 0
+    pending = deque()
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                             initargs = (url,)) as pool:
+        for chunk in _chain(first, reader):
+            if len(pending) >= 2 * workers:
+                n += pending.popleft().result()
+                _progress(n, start)
+            pending.append(pool.submit(_insert_chunk, table, chunk))
+
+        while pending:
+            n += pending.popleft().result()
+            _progress(n, start)
+
+    return n
+
+def _chain(first, reader):
+    yield first
+    for chunk in reader:
+        yield chunk
+
+def _progress(n, start):
+    elapsed = time.time() - start
+    print ('{} rows loaded in {:.1f} s ({:.0f} rows/s)'.format(n, elapsed,
+                                                            n / max(elapsed, 1e-9)))
+
+def main_sqlite(path, catalog = data_link, chunksize = 100000):
+    cred = {'drivername': 'sqlite', 'database': os.path.abspath(path)}
+
+    source_table_name = 'target_list'
+    url = 'sqlite:///{}'.format(cred['database'])
+    engine = create_engine(url)
+    write_yaml(cred, backend = 'sqlite')
+
+    if not engine.dialect.has_table(engine, source_table_name):
+        print ('Creating table: {}'.format(source_table_name))
+        # SQLite allows a single writer, so one insert process
+        stream_catalog(url, source_table_name, catalog, chunksize, workers = 1)
+        print ('Building indexes')
+        engine.execute('CREATE INDEX target_list_cell_idx ON \
+                        {} (cell)'.format(source_table_name))
+        engine.execute('CREATE VIRTUAL TABLE {0}_rtree USING \
+                        rtree(id, ra_min, ra_max, decl_min, decl_max)'.format(
+                        source_table_name))
+        engine.execute('INSERT INTO {0}_rtree SELECT rowid, ra, ra, decl, decl \
+                        FROM {0}'.format(source_table_name))
+
+    else:
+        print ('Table with the name, {}, already exists. Could not create table.'.format(source_table_name))
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+def main(user, password, host, schema_name, catalog = data_link,
+         chunksize = 100000, workers = 4):
     cred = {'username': user, 'host': 'localhost', 'password': password,
             'drivername': 'mysql'}
 
@@ -101,12 +261,12 @@ def main(user, password, host, schema_name):
 
     if not engine.dialect.has_table(engine, source_table_name):
         print ('Creating table: {}'.format(source_table_name))
-        tb = pd.read_csv(data_link)
-        tb.to_sql(source_table_name, engine, index = False,
-                  if_exists = 'replace', chunksize = None)
+        stream_catalog(URL(**cred), source_table_name, catalog, chunksize, workers)
+        print ('Building indexes')
         engine.execute('CREATE INDEX target_list_loc_idx ON \
                         {}.{} (ra, decl)'.format(schema_name, source_table_name))
-        del tb
+        engine.execute('CREATE INDEX target_list_cell_idx ON \
+                        {}.{} (cell)'.format(schema_name, source_table_name))
 
     else:
         print ('Table with the name, {}, already exists. Could not create table.'.format(source_table_name))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+'''
+
+Exports the target_list table to an on-disk index snapshot that the target
+selector memory-maps at startup (see the index.snapshot setting in config.yml).
+
+'''
+
+import sys
+from argparse import (
+    ArgumentParser,
+    ArgumentDefaultsHelpFormatter
+)
+from mk_target_selector.mk_db import Database_Handler
+from mk_target_selector.mk_index import Sky_Index
+
+def cli(prog=sys.argv[0]):
+    usage = "{} [options]".format(prog)
+    description = 'MeerKAT Breakthrough Listen Catalog Snapshot Export'
+
+    parser = ArgumentParser(usage=usage,
+                            description=description,
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-c', '--config',
+        type=str,
+        default="config.yml",
+        help='Target selector configuration file')
+    parser.add_argument(
+        '-o', '--output',
+        type=str,
+        default=None,
+        help='Snapshot directory. Defaults to index.snapshot in the config file')
+    parser.add_argument(
+        '-t', '--table',
+        type=str,
+        default="target_list",
+        help='Name of the catalog table')
+
+    args = parser.parse_args()
+    main(config_file = args.config,
+         output = args.output,
+         table = args.table)
+
+def main(config_file, output, table):
+    db = Database_Handler(config_file)
+
+    if output is None:
+        output = db.cfg.get('index', {}).get('snapshot')
+    if not output:
+        print ('No snapshot directory given and index.snapshot is not set')
+        sys.exit(1)
+
+    checksum = Sky_Index.table_checksum(db.engine, table)
+    index = Sky_Index.from_sql(db.engine, table)
+    index.save(output, checksum = checksum)
+    db.close_conn()
+    print ('Wrote {} sources to {}'.format(len(index), output))
+
+if __name__ == '__main__':
+    cli()
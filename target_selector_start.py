@@ -40,6 +40,8 @@ class Target_Selector:
         # TODO: uncomment when you deploy
         # notify_slack("Target Selector module at MeerKAT has halted. Plase restart!")
         self.log.info("Shutting Down Target Selector")
+        for client in [self.target_client, self.proc_client]:
+            client.stop()
         sys.exit()
 
     def run(self):